@@ -3,14 +3,14 @@ import uvicorn
 from uvicorn.config import LOGGING_CONFIG
 
 from file_monitor import WatchdogThread, UpdateThread
-from memory_server import app, server_state
+from memory_server import app
 from settings import *
 
 if __name__ == "__main__":
 
     watchdog_thread = WatchdogThread(CHAT_PATH, NOTE_PATH)
     watchdog_thread.start()
-    update_thread = UpdateThread(server_state)
+    update_thread = UpdateThread()
     update_thread.start()
 
     LOGGING_CONFIG["formatters"]["access"]["fmt"] = "%(asctime)s %(levelprefix)s %(message)s"
@@ -0,0 +1,84 @@
+# BM25 scoring benchmark: bm25_api.BM25Index against rank_bm25.BM25Okapi, the implementation
+# it replaced, on synthetic digests with a Zipf distributed vocabulary.
+# rank_bm25 is only needed for this benchmark: pip install rank-bm25==0.2.2
+#
+# Usage (from the backend folder):
+#   python -m benchmarks.bench_bm25 --sizes 10000,100000,1000000
+import argparse
+import time
+
+import numpy as np
+
+from bm25_api import BM25Index
+
+def synthetic_corpus(n_docs, vocab_size, doc_len, rng):
+    words = np.array([f"term{i}" for i in range(vocab_size)], dtype=object)
+    ranks = rng.zipf(1.2, size=n_docs * doc_len) % vocab_size
+    lengths = rng.integers(doc_len // 2, doc_len * 3 // 2, size=n_docs)
+    tokens = words[ranks].tolist()
+    corpus, start = [], 0
+    for length in lengths:
+        corpus.append(tokens[start:start + length])
+        start += length
+    return corpus
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - start) / repeat, result
+
+def run(n_docs, args, rng):
+    corpus = synthetic_corpus(n_docs, args.vocab, args.doc_len, rng)
+    doc_ids = [f"Note of doc {i}" for i in range(n_docs)]
+    queries = [[f"term{i}" for i in rng.integers(1, 2000, size=args.query_terms)] for _ in range(args.repeat)]
+    candidates = [rng.choice(n_docs, size=args.candidates, replace=False) for _ in range(args.repeat)]
+    print(f"--- {n_docs} digests ---")
+
+    start = time.perf_counter()
+    index = BM25Index()
+    index.load(zip(doc_ids, corpus))
+    print(f"BM25Index  build: {time.perf_counter() - start:8.2f}s")
+    i = iter(range(args.repeat))
+    t, _ = timed(lambda: (lambda j: index.get_batch_scores(queries[j], [doc_ids[c] for c in candidates[j]]))(next(i)), args.repeat)
+    print(f"BM25Index  candidate scoring: {t*1000:8.2f}ms")
+    i = iter(range(args.repeat))
+    t, _ = timed(lambda: index.get_top_scores(queries[next(i)], args.top_k), args.repeat)
+    print(f"BM25Index  top-{args.top_k} over corpus: {t*1000:8.2f}ms")
+    start = time.perf_counter()
+    index.add_tokens("Note of new doc", corpus[0])
+    print(f"BM25Index  add one digest: {(time.perf_counter() - start)*1000:8.2f}ms")
+    del index
+
+    if n_docs > args.baseline_max_docs:
+        print("BM25Okapi  skipped (--baseline-max-docs)")
+        return
+    from rank_bm25 import BM25Okapi
+    start = time.perf_counter()
+    bm25 = BM25Okapi(corpus, k1=1.5, b=0.75, epsilon=0.25)
+    print(f"BM25Okapi  build: {time.perf_counter() - start:8.2f}s (also the cost of adding one digest before)")
+    i = iter(range(args.repeat))
+    t, _ = timed(lambda: (lambda j: bm25.get_batch_scores(queries[j], candidates[j].tolist()))(next(i)), args.repeat)
+    print(f"BM25Okapi  candidate scoring: {t*1000:8.2f}ms")
+    i = iter(range(args.repeat))
+    t, _ = timed(lambda: np.argsort(-bm25.get_scores(queries[next(i)]))[:args.top_k], args.repeat)
+    print(f"BM25Okapi  top-{args.top_k} over corpus: {t*1000:8.2f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="BM25 scoring benchmark")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma separated numbers of digests")
+    parser.add_argument("--vocab", type=int, default=50000)
+    parser.add_argument("--doc-len", type=int, default=40, help="average tokens per digest")
+    parser.add_argument("--query-terms", type=int, default=6)
+    parser.add_argument("--candidates", type=int, default=40, help="doc_ids scored per query, like the chroma results")
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--baseline-max-docs", type=int, default=1000000, help="skip rank_bm25 above this size")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for n_docs in [int(x) for x in args.sizes.split(",")]:
+        run(n_docs, args, rng)
+
+if __name__ == "__main__":
+    main()
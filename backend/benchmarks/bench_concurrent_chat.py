@@ -0,0 +1,106 @@
+# Concurrency benchmark for the chat pipeline in memory_server.
+# The LLM and the retrieval are replaced with fakes of fixed latency, so the numbers only
+# show how well concurrent conversations overlap (no head-of-line blocking), not model speed.
+#
+# Usage (from the backend folder):
+#   python -m benchmarks.bench_concurrent_chat --users 8 --token-delay 0.02 --search-delay 0.3
+import argparse
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import jwt
+
+import memory_server
+from search_cache import SearchCache
+
+
+def make_chunk(content, finish_reason=None):
+    delta = SimpleNamespace(content=content, function_call=None, role="assistant", tool_calls=None)
+    choice = SimpleNamespace(index=0, finish_reason=finish_reason, delta=delta, logprobs=None)
+    return SimpleNamespace(id="chatcmpl-bench", object="chat.completion.chunk", created=0, model="bench", choices=[choice])
+
+
+class FakeCompletions:
+    def __init__(self, token_delay, n_tokens):
+        self.token_delay = token_delay
+        self.n_tokens = n_tokens
+
+    async def create(self, messages, **kwargs):
+        searched = any("search result" in m["content"] for m in messages[-2:])
+        if searched:
+            tokens = ["<REPLY>"] + [f"word{i} " for i in range(self.n_tokens)]
+        else:
+            tokens = ["<SEARCH>\n", "bench query one\n", "bench query two\n"]
+
+        async def stream():
+            for token in tokens:
+                await asyncio.sleep(self.token_delay)
+                yield make_chunk(token)
+            yield make_chunk("", finish_reason="stop")
+        return stream()
+
+
+def install_fakes(token_delay, n_tokens, search_delay):
+    memory_server.async_client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions(token_delay, n_tokens)))
+
+    def fake_fetch(queries):
+        time.sleep(search_delay) # blocking on purpose, like Chroma/BM25/disk
+        return [None for _ in queries]
+    memory_server.fetch_queries = fake_fetch
+    memory_server.rank_contexts = lambda queries, fetched: []
+    memory_server.search_cache = SearchCache(max_size=0) # every search retrieves
+
+
+async def one_conversation(client, headers, i, run_tag):
+    body = {
+        "messages": [
+            {"role": "system", "content": "bench"},
+            {"role": "user", "content": f"hello from user {i} ({run_tag})"},
+        ],
+        "stream": True,
+        "max_tokens": 128,
+    }
+    start = time.perf_counter()
+    response = await client.post("/v1/chat/completions", json=body, headers=headers)
+    response.raise_for_status()
+    assert "[DONE]" in response.text
+    return time.perf_counter() - start
+
+
+async def run(users):
+    token = jwt.encode({"username": "bench"}, "shared_key", algorithm="HS256")
+    headers = {"Authorization": f"Bearer {token}"}
+    async with httpx.AsyncClient(app=memory_server.app, base_url="http://bench", timeout=None) as client:
+        await one_conversation(client, headers, -1, "warm up")
+
+        start = time.perf_counter()
+        for i in range(users):
+            await one_conversation(client, headers, i, "serial")
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        latencies = await asyncio.gather(*[one_conversation(client, headers, i, "concurrent") for i in range(users)])
+        concurrent = time.perf_counter() - start
+    return serial, concurrent, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent chat streaming benchmark")
+    parser.add_argument("--users", type=int, default=8, help="number of simultaneous conversations")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="seconds between streamed tokens")
+    parser.add_argument("--tokens", type=int, default=50, help="tokens in each reply")
+    parser.add_argument("--search-delay", type=float, default=0.3, help="seconds a (blocking) search takes")
+    args = parser.parse_args()
+
+    install_fakes(args.token_delay, args.tokens, args.search_delay)
+    serial, concurrent, latencies = asyncio.run(run(args.users))
+    print(f"users: {args.users}, search workers: {memory_server.SEARCH_MAX_WORKERS}")
+    print(f"serial:     {serial:.2f}s total, {serial/args.users:.2f}s per conversation")
+    print(f"concurrent: {concurrent:.2f}s total, max latency {max(latencies):.2f}s")
+    print(f"overlap speedup: {serial/concurrent:.1f}x (ideal {args.users}x while users <= search workers)")
+
+
+if __name__ == "__main__":
+    main()
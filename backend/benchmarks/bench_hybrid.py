@@ -0,0 +1,121 @@
+# Hybrid retrieval benchmark: recall@k and latency of vector candidates alone against vector
+# candidates fused with full-corpus BM25 candidates (retrivial_ranking.fuse_scores).
+# "vector" is also the order of HYBRID_FUSION = "none", where BM25 doesn't change the ranking.
+# The corpus is synthetic: every digest belongs to a topic, which decides its embedding, and
+# mentions a few names only it contains. Half the queries ask for a digest by one of its names
+# with the embedding of its topic only (keyword queries), the other half are paraphrases close
+# to the digest's own embedding that share no words with it (semantic queries).
+# The vector store is a brute force numpy search standing in for Chroma.
+#
+# Usage (from the backend folder):
+#   python -m benchmarks.bench_hybrid --docs 20000 --queries 500
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nltk
+nltk.data.path.append(os.path.abspath("nltk_data"))
+
+def synthetic_corpus(args, rng):
+    topic_words = [[f"topic{t}word{i}" for i in range(30)] for t in range(args.topics)]
+    common_words = [f"common{i}" for i in range(200)]
+    centroids = rng.normal(size=(args.topics, args.dim))
+    doc_topics = rng.integers(0, args.topics, size=args.docs)
+    embeddings = centroids[doc_topics] + rng.normal(scale=args.noise, size=(args.docs, args.dim))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    corpus = []
+    for doc, topic in enumerate(doc_topics):
+        words = list(rng.choice(topic_words[topic], size=30)) + list(rng.choice(common_words, size=30))
+        words += [f"name{doc}x{i}" for i in range(3)]
+        corpus.append([str(word) for word in words])
+    return corpus, embeddings, centroids, doc_topics
+
+def make_queries(args, rng, embeddings, centroids, doc_topics):
+    queries = []
+    for i, doc in enumerate(rng.choice(args.docs, size=args.queries, replace=False)):
+        if i % 2 == 0: # keyword query
+            tokens = [f"name{doc}x{rng.integers(3)}", "common1"]
+            vector = centroids[doc_topics[doc]] + rng.normal(scale=args.noise, size=args.dim)
+        else: # semantic query
+            tokens = ["paraphrase", "words"]
+            vector = embeddings[doc] + rng.normal(scale=args.noise / 4, size=args.dim)
+        queries.append((int(doc), tokens, vector / np.linalg.norm(vector)))
+    return queries
+
+def vector_top(embeddings, vector, n):
+    similarity = embeddings @ vector
+    top = np.argpartition(-similarity, n)[:n]
+    top = top[np.argsort(-similarity[top])]
+    return top, similarity[top]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=400)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=64)
+    parser.add_argument("--noise", type=float, default=0.6)
+    parser.add_argument("--vector-candidates", type=int, default=20)
+    parser.add_argument("--bm25-candidates", type=int, default=20)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="bench_hybrid_")) # retrivial_ranking opens Chroma in the working folder
+    from bm25_api import BM25Index
+    from retrivial_ranking import fuse_scores
+
+    rng = np.random.default_rng(0)
+    corpus, embeddings, centroids, doc_topics = synthetic_corpus(args, rng)
+    doc_ids = [f"doc {i}" for i in range(args.docs)]
+    index = BM25Index()
+    index.load((doc_id, tokens, None) for doc_id, tokens in zip(doc_ids, corpus))
+    queries = make_queries(args, rng, embeddings, centroids, doc_topics)
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    methods = ["vector", "zscore", "rrf"]
+    hits = {method: [0, 0] for method in methods} # keyword, semantic
+    times = {"vector": 0., "bm25": 0., "fusion": 0., "parallel": 0.}
+    for i, (doc, tokens, vector) in enumerate(queries):
+        start = time.perf_counter()
+        top, similarity = vector_top(embeddings, vector, args.vector_candidates)
+        times["vector"] += time.perf_counter() - start
+        start = time.perf_counter()
+        bm25_top = index.get_top_scores(tokens, args.bm25_candidates)
+        times["bm25"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        bm25_future = executor.submit(index.get_top_scores, tokens, args.bm25_candidates)
+        vector_top(embeddings, vector, args.vector_candidates)
+        bm25_future.result()
+        times["parallel"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        vector_ids = [doc_ids[j] for j in top]
+        vector_set = set(vector_ids)
+        for method in methods:
+            if method == "vector":
+                ranked = vector_ids
+            else:
+                bm25_only = [doc_id for doc_id, _ in bm25_top if doc_id not in vector_set]
+                candidate_ids = vector_ids + bm25_only
+                vector_scores = np.concatenate([similarity, np.full(len(bm25_only), np.nan)])
+                fused = fuse_scores(vector_scores, index.get_batch_scores(tokens, candidate_ids) / len(tokens), method=method)
+                ranked = [candidate_ids[j] for j in np.argsort(-fused, kind='stable')]
+            hits[method][i % 2] += f"doc {doc}" in ranked[:args.k]
+        times["fusion"] += (time.perf_counter() - start) / (len(methods) - 1)
+
+    n_keyword, n_semantic = (len(queries) + 1) // 2, len(queries) // 2
+    print(f"{args.docs} digests, {len(queries)} queries, {args.vector_candidates} vector + {args.bm25_candidates} BM25 candidates")
+    print(f"{'method':>8} {'recall@' + str(args.k):>10} {'keyword':>8} {'semantic':>9}")
+    for method in methods:
+        keyword, semantic = hits[method]
+        print(f"{method:>8} {(keyword + semantic) / len(queries):>10.3f} {keyword / n_keyword:>8.3f} {semantic / n_semantic:>9.3f}")
+    n = len(queries)
+    print(f"latency per query: vector {times['vector'] / n * 1000:.2f}ms, bm25 top-k {times['bm25'] / n * 1000:.2f}ms, "
+          f"both in parallel {times['parallel'] / n * 1000:.2f}ms, fusion {times['fusion'] / n * 1000:.2f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Ingestion throughput benchmark: ingestion.IngestionPipeline against handling one file at a time
+# the way UpdateThread used to, over a synthetic notes folder.
+# The LLM and the embedding model are replaced with stubs of fixed latency, Chroma, the digest
+# folder and BM25 are real and live in a temporary folder.
+#
+# Usage (from the backend folder):
+#   python -m benchmarks.bench_ingestion --files 200 --llm-delay 0.5 --embed-delay 0.05
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+
+import nltk
+nltk.data.path.append(os.path.abspath("nltk_data"))
+
+WORDS = "memory garden travel project budget family coffee music library weekend deadline recipe".split()
+
+def write_notes(folder, n_files, n_sections, prefix):
+    os.makedirs(folder)
+    paths = []
+    for i in range(n_files):
+        sections = []
+        for j in range(n_sections):
+            body = ' '.join(WORDS[(i * 7 + j * 3 + k) % len(WORDS)] for k in range(60))
+            sections.append(f"# Section {j}\n{body}.\n")
+        path = os.path.join(folder, f"{prefix} note {i}.md")
+        with open(path, "w", encoding='utf-8') as f:
+            f.write('\n'.join(sections))
+        paths.append(path)
+    return paths
+
+def make_stubs(args):
+    def chat(messages):
+        time.sleep(args.llm_delay)
+        content = messages[-1]["content"]
+        return "- " + ' '.join(content.split()[3:40])
+
+    def embed(chunks):
+        time.sleep(args.embed_delay)
+        return [[b / 255 for b in hashlib.sha256(chunk.encode('utf-8')).digest()] for chunk in chunks]
+
+    return chat, embed
+
+def run_serial(pipeline, doc_manager, paths):
+    from ingestion import IngestJob
+    for seq, path in enumerate(paths):
+        job = IngestJob(path, "on_created", seq)
+        for stage in (pipeline._read, pipeline._digest, pipeline._chunk, pipeline._embed):
+            stage(job)
+        doc_manager.remove_document_by_name(job.title)
+        for document in job.prepared:
+            doc_manager.apply_changes([document])
+
+def run_pipeline(pipeline, paths):
+    for path in paths:
+        pipeline.submit(path, "on_created")
+    pipeline.join()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--sections", type=int, default=3, help="sections per note, one LLM call each")
+    parser.add_argument("--llm-delay", type=float, default=0.3)
+    parser.add_argument("--embed-delay", type=float, default=0.03)
+    parser.add_argument("--digest-workers", type=int, default=8)
+    parser.add_argument("--embed-workers", type=int, default=2)
+    parser.add_argument("--serial-files", type=int, default=20, help="files for the one-at-a-time baseline")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="bench_ingestion_")
+    os.chdir(root) # the digest folder, Chroma and BM25 are created relative to the working folder
+    import llm_utils
+    from chroma_doc_manager import doc_manager
+    from ingestion import IngestionPipeline
+
+    chat, embed = make_stubs(args)
+    llm_utils.chat = chat
+    workers = {"read": 2, "digest": args.digest_workers, "chunk": 2, "embed": args.embed_workers}
+    pipeline = IngestionPipeline(doc_manager, workers=workers, embed=embed)
+    print(f"workers {workers}, llm delay {args.llm_delay}s per section, embed delay {args.embed_delay}s per request")
+
+    paths = write_notes(os.path.join(root, "notes_serial"), args.serial_files, args.sections, "serial")
+    start = time.perf_counter()
+    run_serial(pipeline, doc_manager, paths)
+    serial = len(paths) / (time.perf_counter() - start) * 60
+    print(f"one at a time: {len(paths)} files, {serial:.0f} files/min")
+
+    paths = write_notes(os.path.join(root, "notes_pipeline"), args.files, args.sections, "pipeline")
+    start = time.perf_counter()
+    run_pipeline(pipeline, paths)
+    pipelined = len(paths) / (time.perf_counter() - start) * 60
+    print(f"pipeline: {len(paths)} files, {pipelined:.0f} files/min, {pipelined / serial:.1f}x")
+    print(pipeline.stats())
+
+if __name__ == "__main__":
+    main()
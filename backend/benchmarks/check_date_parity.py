@@ -0,0 +1,72 @@
+# Parity check of date_extraction against dateparser: search_query_dates must find the same date
+# strings and days as dateparser.search.search_dates, and parse_date of every date string found the
+# same day as dateparser.parse, for queries with and without dates, numeric dates, several dates,
+# relative phrases and words dateparser joins to a date. Also prints how many queries the
+# recognizer answered without dateparser and the time per query of both.
+#
+# Usage (from the backend folder):
+#   python -m benchmarks.check_date_parity
+import sys
+import time
+from datetime import datetime
+
+from dateparser import parse
+from dateparser.search import search_dates
+
+import date_extraction
+from date_extraction import language_list, search_query_dates, parse_date
+
+QUERIES = [
+    "hello there", "python 3.11 release", "v2023.1", "room 2023", "version 1.2023", "January", "the march 2024 plan",
+    "what did I do in 2023", "in 2021", "I went there in 2023, fun", "2023 in review", "trip 2023 with mom", "x. 2023",
+    "the year 1999", "in the year 2023", "notes from the year 2023", "year 2023", "what about 2023?", "x and 2023",
+    "in 2022 and 2023", "2019 and 2020 holidays", "june and july", "march 2024 to may 2024", "2024-01-01 and 2024-02-01",
+    "Peter 12/05/2023", "5.3.2024", "call on 12.05.2023", "12-05-2023 note", "topic 2023/5", "2023年5月",
+    "2024-03-05 meeting", "meeting on 2024/03/05", "March 2024 trip", "March 2024 with the team", "May 5, 2024",
+    "party on May 5, 2024", "5 May 2024", "5th of May 2024", "my birthday in june", "we met in june at home",
+    "mom in june.", "june, mom", "june, at home", "notes by june", "at the june", "may I ask about the trip",
+    "yesterday dinner", "in yesterday", "yesterday and today", "yesterday, 3 pm", "yesterday at noon",
+    "last week plans", "go in last week", "last week at the office", "what happened last month", "3 days ago",
+    "meeting 3 days ago with bob", "about 3 days ago", "foo in 3 days ago", "2 weeks ago gym", "a year ago",
+    "on monday", "the concert on friday", "books I read", "plans for next year", "10 years ago", "in 3 days",
+]
+
+def same(fast, reference):
+    if not fast or not reference:
+        return not fast and not reference
+    return [(s, d.date()) for s, d in fast] == [(s, d.date()) for s, d in reference]
+
+def fast_path(query_str):
+    dates = date_extraction._recognize(query_str, datetime.now())
+    return bool(dates) or (dates is not None and not date_extraction._vocabulary_regex.search(query_str))
+
+def main():
+    settings = {"PREFER_DATES_FROM": "past"}
+    failures = 0
+    search_dates("warm up on 2024-01-01", languages=language_list, settings=settings) # loads the locales for both
+    start = time.perf_counter()
+    fast_results = [search_query_dates(query_str) for query_str in QUERIES]
+    fast_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    references = [search_dates(query_str, languages=language_list, settings=settings) for query_str in QUERIES]
+    reference_seconds = time.perf_counter() - start
+    for query_str, fast, reference in zip(QUERIES, fast_results, references):
+        if not same(fast, reference):
+            failures += 1
+            print(f"search {query_str!r}: {fast} != dateparser {reference}")
+            continue
+        for date_str, _ in reference or []:
+            for prefer in ("first", "last"):
+                date = parse_date(date_str, prefer)
+                expected = parse(date_str, languages=language_list, settings={**settings, "PREFER_MONTH_OF_YEAR": prefer, "PREFER_DAY_OF_MONTH": prefer})
+                if (date and date.date()) != (expected and expected.date()):
+                    failures += 1
+                    print(f"parse {date_str!r} ({prefer}): {date} != dateparser {expected}")
+    recognized = sum(fast_path(query_str) for query_str in QUERIES)
+    print(f"{len(QUERIES)} queries, {failures} mismatches, {recognized} answered without dateparser")
+    print(f"search_query_dates {fast_seconds / len(QUERIES) * 1000:.2f}ms/query, dateparser {reference_seconds / len(QUERIES) * 1000:.2f}ms/query")
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
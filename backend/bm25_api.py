@@ -1,20 +1,23 @@
 import os
-import statistics
+import json
+import shutil
+import hashlib
+from array import array
+
+import numpy as np
+import scipy.sparse as sp
 
 import nltk
 nltk.data.path.append("nltk_data")
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
 # from nltk.stem import PorterStemmer
-from rank_bm25 import BM25Okapi
 from settings import LANGUAGE_PREFERENCE
 from threading import Lock
 
-lock = Lock()
-
-corpus_index = None
-# Initialize BM25
-bm25 = None
+DIGEST_FOLDER = "digests"
+INDEX_FOLDER = os.path.join(DIGEST_FOLDER, "bm25")
+INDEX_ARRAYS = ["tf_data", "tf_indices", "tf_indptr", "column_indptr", "column_terms", "doc_len"]
 
 # Initialize stemmer and stopwords
 # stemmer = PorterStemmer()
@@ -22,7 +25,7 @@ stop_words = set(stopwords.words(LANGUAGE_PREFERENCE.lower()))
 
 if LANGUAGE_PREFERENCE == 'Chinese':
     import jieba
-		
+
 # Pre-processing function
 def preprocess(text):
     if LANGUAGE_PREFERENCE == 'Chinese':
@@ -33,63 +36,443 @@ def preprocess(text):
     tokens = [token for token in tokens if token not in stop_words and token.isalpha()]
     return tokens
 
+def term_frequencies(tokens):
+    frequencies = {}
+    for token in tokens:
+        frequencies[token] = frequencies.get(token, 0) + 1
+    return frequencies
+
+# Okapi BM25 over an inverted index that can be changed one document at a time.
+# Scores are the same as rank_bm25.BM25Okapi built on the same corpus.
+#
+# Documents live in two segments: a sparse term-document matrix (CSR, one row of
+# postings per term) that is scored with one gather and sum, and a small dict based
+# segment for documents added since the last merge. Adding a document only touches the
+# small segment and removing one only clears its column, so an update costs O(doc);
+# the segments are merged with vectorized operations once the small one grows.
+#
+# With a path, every merged matrix is also written there as .npy arrays and opened
+# again with mmap, so the postings don't have to stay in memory and the next start
+# doesn't need to tokenize the digests again (see open_index).
+class BM25Index():
+    def __init__(self, k1=1.5, b=0.75, epsilon=0.25, merge_size=1024, path=None):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.merge_size = merge_size
+        self.path = path
+        self.lock = Lock()
+        self.save_lock = Lock()
+        self.generation = 0 # increased by every merge, names the folder the matrix is saved to
+        self.vocab = {} # term -> row of the term-document matrix
+        # merged segment
+        self.tf = sp.csr_matrix((0, 0), dtype=np.float32) # terms x docs
+        self.doc_ids = [] # column -> doc_id
+        self.doc_column = {} # doc_id -> column
+        self.doc_len = np.zeros(0, dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool) # False for removed or replaced documents
+        self.df = np.zeros(0, dtype=np.int64)
+        self.column_indptr = np.zeros(1, dtype=np.int32)
+        self.column_terms = np.zeros(0, dtype=np.int32)
+        # recent segment
+        self.recent_terms = {} # doc_id -> {term: term frequency}
+        self.recent_postings = {} # term -> {doc_id: term frequency}
+        self.recent_len = {} # doc_id -> number of tokens
+        self.doc_stamps = {} # doc_id -> [mtime_ns, size, content hash] of the indexed digest file
+        self.n_docs = 0
+        self.total_len = 0
+        self._cache = {} # values derived from the whole corpus, cleared after a change
+
+    def __len__(self):
+        return self.n_docs
+
+    def add_tokens(self, doc_id, tokens, stamp=None):
+        self.update([(doc_id, tokens, stamp)])
+
+    # Add (doc_id, tokens, stamp) items and remove doc_ids with one lock, merging at most once
+    def update(self, items, removed=()):
+        items = [(doc_id, tokens, stamp, term_frequencies(tokens)) for doc_id, tokens, stamp in items]
+        snapshot = None
+        with self.lock:
+            for doc_id in removed:
+                self._remove(doc_id)
+            for doc_id, tokens, stamp, frequencies in items:
+                self._remove(doc_id)
+                self.recent_terms[doc_id] = frequencies
+                self.recent_len[doc_id] = len(tokens)
+                self.doc_stamps[doc_id] = stamp
+                for term, freq in frequencies.items():
+                    self.recent_postings.setdefault(term, {})[doc_id] = freq
+                self.n_docs += 1
+                self.total_len += len(tokens)
+            self._cache.clear()
+            if len(self.recent_terms) >= self.merge_size:
+                snapshot = self._merge()
+        if snapshot:
+            self.save(snapshot)
+
+    # Merge the recent documents into the matrix and save it, if anything changed since the last save
+    def flush(self):
+        with self.lock:
+            if not self.recent_terms and self.alive.all():
+                return
+            snapshot = self._merge()
+        if snapshot:
+            self.save(snapshot)
+
+    def remove(self, doc_id):
+        with self.lock:
+            return self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        column = self.doc_column.pop(doc_id, None)
+        self.doc_stamps.pop(doc_id, None)
+        if column is not None:
+            self.alive[column] = False
+            self.df[self.column_terms[self.column_indptr[column]:self.column_indptr[column + 1]]] -= 1
+            self.total_len -= int(self.doc_len[column])
+        else:
+            frequencies = self.recent_terms.pop(doc_id, None)
+            if frequencies is None:
+                return False
+            self.total_len -= self.recent_len.pop(doc_id)
+            for term in frequencies:
+                docs = self.recent_postings[term]
+                del docs[doc_id]
+                if not docs:
+                    del self.recent_postings[term]
+        self.n_docs -= 1
+        self._cache.clear()
+        return True
+
+    def _merge(self):
+        # drop removed columns, then append the recent documents as new columns
+        columns = np.flatnonzero(self.alive)
+        tf = self.tf if len(columns) == len(self.alive) else self.tf[:, columns]
+        doc_ids = [self.doc_ids[i] for i in columns] + list(self.recent_terms)
+        rows, cols, data = [], [], []
+        for col, frequencies in enumerate(self.recent_terms.values()):
+            for term, freq in frequencies.items():
+                rows.append(self.vocab.setdefault(term, len(self.vocab)))
+                cols.append(col)
+                data.append(freq)
+        recent = sp.csr_matrix((np.array(data, dtype=np.float32), (rows, cols)), shape=(len(self.vocab), len(self.recent_terms)))
+        tf = sp.csr_matrix((tf.data, tf.indices, tf.indptr), shape=tf.shape)
+        tf.resize((len(self.vocab), tf.shape[1])) # rows for new terms
+        doc_len = np.concatenate([self.doc_len[columns], np.fromiter(self.recent_len.values(), dtype=np.float32, count=len(self.recent_len))])
+        self._set_matrix(sp.hstack([tf, recent], format='csr', dtype=np.float32), doc_ids, doc_len)
+        self.recent_terms = {}
+        self.recent_postings = {}
+        self.recent_len = {}
+        return self._snapshot()
+
+    def _set_matrix(self, tf, doc_ids, doc_len, forward=None):
+        tf.sort_indices()
+        self.tf = tf
+        self.doc_ids = doc_ids
+        self.doc_column = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        self.doc_len = doc_len
+        self.alive = np.ones(len(doc_ids), dtype=bool)
+        self.df = np.diff(tf.indptr).astype(np.int64) # per row document frequency of alive columns
+        # column -> rows, so removing a document can update df without scanning postings
+        if forward is None:
+            forward = tf.tocsc()
+            forward = (forward.indptr, forward.indices)
+        self.column_indptr, self.column_terms = forward
+        self._cache.clear()
+
+    def _snapshot(self):
+        # the matrix arrays are replaced but never changed in place, so they can be written outside of the lock
+        if not self.path:
+            return None
+        self.generation += 1
+        arrays = {
+            "tf_data": self.tf.data, "tf_indices": self.tf.indices, "tf_indptr": self.tf.indptr,
+            "column_indptr": self.column_indptr, "column_terms": self.column_terms, "doc_len": self.doc_len,
+        }
+        meta = {
+            "k1": self.k1, "b": self.b, "epsilon": self.epsilon,
+            "vocab": list(self.vocab),
+            "docs": [[doc_id, self.doc_stamps.get(doc_id)] for doc_id in self.doc_ids],
+        }
+        return self.generation, arrays, meta
+
+    def save(self, snapshot):
+        generation, arrays, meta = snapshot
+        with self.save_lock: # saves finish one at a time, but not necessarily in the order of their snapshots
+            if generation <= saved_generation(self.path):
+                return # a newer matrix is saved already
+            folder = os.path.join(self.path, str(generation))
+            os.makedirs(folder, exist_ok=True)
+            for name, arr in arrays.items():
+                np.save(os.path.join(folder, name + ".npy"), arr)
+            with open(os.path.join(folder, "meta.json"), "w", encoding='utf-8') as f:
+                json.dump(meta, f, ensure_ascii=False)
+            # switch to the new generation atomically, then drop the older ones
+            current = os.path.join(self.path, "CURRENT")
+            with open(current + ".tmp", "w") as f:
+                f.write(str(generation))
+            os.replace(current + ".tmp", current)
+            for name in os.listdir(self.path):
+                if name.isdigit() and int(name) < generation:
+                    shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        print(f"bm25 index saved: {len(meta['docs'])} docs")
+        # use the mapped files instead of the arrays in memory, unless the matrix has changed meanwhile
+        tf, forward, doc_len = load_arrays(folder, len(meta["vocab"]), len(meta["docs"]))
+        with self.lock:
+            if self.generation == generation:
+                self.tf, self.doc_len = tf, doc_len
+                self.column_indptr, self.column_terms = forward
+                self._cache.clear()
+
+    def _length_norm(self):
+        # per column k1*(1-b+b*dl/avgdl), only depends on document lengths
+        if 'length_norm' not in self._cache:
+            avgdl = self.total_len / self.n_docs
+            self._cache['length_norm'] = self.k1 * (1 - self.b + self.b * self.doc_len / avgdl)
+        return self._cache['length_norm']
+
+    def _raw_idf(self, df):
+        return np.log(self.n_docs - df + 0.5) - np.log(df + 0.5)
+
+    def _average_idf(self):
+        if 'average_idf' not in self._cache:
+            df = self.df.astype(np.float64)
+            new_terms = []
+            for term, docs in self.recent_postings.items():
+                if term in self.vocab:
+                    df[self.vocab[term]] += len(docs)
+                else:
+                    new_terms.append(len(docs))
+            df = np.concatenate([df[df > 0], new_terms])
+            self._cache['average_idf'] = self._raw_idf(df).sum() / len(df)
+        return self._cache['average_idf']
+
+    def _idf(self, query):
+        # returns matrix rows (-1 for terms only in recent documents) and idf of the query terms
+        rows = np.array([self.vocab.get(term, -1) for term in query], dtype=np.int64)
+        df = np.array([len(self.recent_postings.get(term, ())) for term in query], dtype=np.float64)
+        df[rows >= 0] += self.df[rows[rows >= 0]]
+        idf = np.where(df > 0, self._raw_idf(df), 0)
+        if (idf < 0).any():
+            # same floor as BM25Okapi for terms that appear in more than half of the documents
+            idf[idf < 0] = self.epsilon * self._average_idf()
+        return rows, idf
+
+    def _recent_scores(self, query, idf, doc_ids):
+        scores = dict.fromkeys(doc_ids, 0.0)
+        avgdl = self.total_len / self.n_docs
+        for term, term_idf in zip(query, idf):
+            for doc_id, freq in self.recent_postings.get(term, {}).items():
+                if doc_id in scores:
+                    dl = self.recent_len[doc_id]
+                    scores[doc_id] += term_idf * (freq * (self.k1 + 1) / (freq + self.k1 * (1 - self.b + self.b * dl / avgdl)))
+        return scores
+
+    def _weights(self, tf, columns, idf):
+        return idf * tf * (self.k1 + 1) / (tf + self._length_norm()[columns])
+
+    def get_batch_scores(self, query, doc_ids):
+        with self.lock:
+            scores = np.zeros(len(doc_ids))
+            if not self.n_docs or not query:
+                return scores
+            rows, idf = self._idf(query)
+            columns = np.array([self.doc_column.get(doc_id, -1) for doc_id in doc_ids], dtype=np.int64)
+            in_matrix = np.flatnonzero(columns >= 0)
+            columns = columns[in_matrix]
+            # gather the term frequencies of the candidate columns from each postings row
+            for row, term_idf in zip(rows, idf):
+                start, end = self.tf.indptr[row], self.tf.indptr[row + 1]
+                if row < 0 or start == end:
+                    continue
+                postings = self.tf.indices[start:end]
+                pos = np.minimum(np.searchsorted(postings, columns), end - start - 1)
+                tf = np.where(postings[pos] == columns, self.tf.data[start + pos], 0)
+                scores[in_matrix] += self._weights(tf, columns, term_idf)
+            recent = [doc_id for doc_id in doc_ids if doc_id in self.recent_terms]
+            if recent:
+                recent_scores = self._recent_scores(query, idf, recent)
+                for i, doc_id in enumerate(doc_ids):
+                    if doc_id in recent_scores:
+                        scores[i] = recent_scores[doc_id]
+            return scores
+
+    def get_top_scores(self, query, k):
+        with self.lock:
+            if not self.n_docs or not query:
+                return []
+            rows, idf = self._idf(query)
+            # one gather of the postings rows and a sum per column
+            sub = self.tf[rows[rows >= 0]]
+            entry_rows = np.repeat(np.arange(sub.shape[0]), np.diff(sub.indptr))
+            weights = self._weights(sub.data, sub.indices, idf[rows >= 0][entry_rows]) * self.alive[sub.indices]
+            matrix_scores = np.bincount(sub.indices, weights=weights, minlength=len(self.doc_ids))
+            recent_scores = self._recent_scores(query, idf, self.recent_terms)
+
+            columns = np.flatnonzero(self.alive)
+            doc_ids = [self.doc_ids[i] for i in columns] + list(recent_scores)
+            scores = np.concatenate([matrix_scores[columns], np.fromiter(recent_scores.values(), dtype=np.float64, count=len(recent_scores))])
+            if k < len(scores):
+                top = np.argpartition(-scores, k)[:k]
+            else:
+                top = np.arange(len(scores))
+            top = top[np.argsort(-scores[top])]
+            return [(doc_ids[i], scores[i]) for i in top if scores[i] > 0]
+
+    # Build the matrix in one pass, used for the full rebuild
+    def load(self, items):
+        rows, cols, data, doc_ids, doc_len, stamps = array('i'), array('i'), array('f'), [], array('f'), {}
+        for doc_id, tokens, stamp in items:
+            stamps[doc_id] = stamp
+            frequencies = term_frequencies(tokens)
+            col = len(doc_ids)
+            for term, freq in frequencies.items():
+                rows.append(self.vocab.setdefault(term, len(self.vocab)))
+                cols.append(col)
+                data.append(freq)
+            doc_ids.append(doc_id)
+            doc_len.append(len(tokens))
+        tf = sp.csr_matrix((np.frombuffer(data, dtype=np.float32), (np.frombuffer(rows, dtype=np.int32), np.frombuffer(cols, dtype=np.int32))),
+                           shape=(len(self.vocab), len(doc_ids)))
+        with self.lock:
+            self._set_matrix(tf, doc_ids, np.frombuffer(doc_len, dtype=np.float32).copy())
+            self.doc_stamps = stamps
+            self.n_docs = len(doc_ids)
+            self.total_len = int(self.doc_len.sum())
+            snapshot = self._snapshot()
+        if snapshot:
+            self.save(snapshot)
+
+def load_arrays(folder, n_terms, n_docs):
+    arrays = {name: np.load(os.path.join(folder, name + ".npy"), mmap_mode='r') for name in INDEX_ARRAYS}
+    tf = sp.csr_matrix((arrays["tf_data"], arrays["tf_indices"], arrays["tf_indptr"]), shape=(n_terms, n_docs), copy=False)
+    tf.has_sorted_indices = True # saved sorted, don't scan the mapped postings to find out
+    return tf, (arrays["column_indptr"], arrays["column_terms"]), arrays["doc_len"]
+
+# Generation of the index saved under path, 0 without one. A new index continues from it, so
+# saving it never writes into the folder of the one in use
+def saved_generation(path):
+    try:
+        with open(os.path.join(path, "CURRENT")) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 0
+
+# Open the index saved under path, or return None if there is none or it can't be read
+def open_index(path):
+    try:
+        with open(os.path.join(path, "CURRENT")) as f:
+            generation = int(f.read())
+        folder = os.path.join(path, str(generation))
+        with open(os.path.join(folder, "meta.json"), encoding='utf-8') as f:
+            meta = json.load(f)
+        tf, forward, doc_len = load_arrays(folder, len(meta["vocab"]), len(meta["docs"]))
+    except (OSError, ValueError, KeyError):
+        return None
+    index = BM25Index(k1=meta["k1"], b=meta["b"], epsilon=meta["epsilon"], path=path)
+    index.generation = generation
+    index.vocab = {term: i for i, term in enumerate(meta["vocab"])}
+    doc_ids = [doc_id for doc_id, _ in meta["docs"]]
+    index._set_matrix(tf, doc_ids, doc_len, forward)
+    index.doc_stamps = {doc_id: stamp for doc_id, stamp in meta["docs"]}
+    index.n_docs = len(doc_ids)
+    index.total_len = int(doc_len.sum())
+    return index
+
+bm25_index = BM25Index(path=INDEX_FOLDER)
+
+def is_digest_file(file):
+    return file.startswith("Conversation") or file.startswith("Note")
+
+def load_digest(file):
+    with open(os.path.join(DIGEST_FOLDER, file), encoding='utf-8') as f:
+        return f.read()
+
+def content_hash(document):
+    return hashlib.sha1(document.encode('utf-8')).hexdigest()
+
+def digest_stamp(file, document):
+    stat = os.stat(os.path.join(DIGEST_FOLDER, file))
+    return [stat.st_mtime_ns, stat.st_size, content_hash(document)]
+
+# Open the saved index and bring it up to date with the digest folder. Only digests whose
+# mtime or size changed are read, and only the ones whose content hash changed are tokenized.
+# Without a usable saved index the whole folder is tokenized into a new one.
+# Queries keep using the old index until the new one is swapped in.
 def update_corpus():
-    global corpus_index
-    global bm25
-    with lock:
-        corpus = []
-        corpus_index = {}
-        dir = "digests"
-        files = os.listdir(dir)
-        # doc_manager.client.delete_collection('digests')
-        i = 0
-        for file in files:
-            if not file.startswith("Conversation") and not file.startswith("Note"):
+    global bm25_index
+    files = {file.replace(';', ':'): file for file in os.listdir(DIGEST_FOLDER) if is_digest_file(file)} # revert conversion for Windows file name rules
+    index = open_index(INDEX_FOLDER)
+    if index is None:
+        print("bm25 index not found, tokenizing all digests")
+        index = BM25Index(path=INDEX_FOLDER)
+        index.generation = saved_generation(INDEX_FOLDER)
+        index.load((doc_id, preprocess(document), digest_stamp(file, document))
+                   for doc_id, file, document in ((doc_id, file, load_digest(file)) for doc_id, file in files.items()))
+    else:
+        n_changed = 0
+        for doc_id in [doc_id for doc_id in index.doc_stamps if doc_id not in files]:
+            index.remove(doc_id)
+            n_changed += 1
+        for doc_id, file in files.items():
+            stat = os.stat(os.path.join(DIGEST_FOLDER, file))
+            stamp = index.doc_stamps.get(doc_id)
+            if stamp and stamp[0] == stat.st_mtime_ns and stamp[1] == stat.st_size:
+                continue
+            document = load_digest(file)
+            new_stamp = [stat.st_mtime_ns, stat.st_size, content_hash(document)]
+            if stamp and stamp[2] == new_stamp[2]: # touched but not changed
+                index.doc_stamps[doc_id] = new_stamp
                 continue
-            title = file.replace(';', ':') # revert conversion for Windows file name rules
-            digest = None
-            with open(os.path.join(dir, file), encoding='utf-8') as f:
-                digest = f.read()
-                corpus.append(digest)
-                corpus_index[title] = i
-                i += 1
-                
-        # Preprocess the corpus
-        if corpus:
-            processed_corpus = [preprocess(doc) for doc in corpus]
-            bm25 = BM25Okapi(processed_corpus, k1=1.5, b=0.75, epsilon=0.25)
+            index.add_tokens(doc_id, preprocess(document), new_stamp)
+            n_changed += 1
+        index.flush()
+        print(f"bm25 index opened, {n_changed} digests changed since saved")
+    bm25_index = index
     print("bm25 corpus updated")
 
+def add_document(doc_id, document):
+    tokens = preprocess(document) # outside of the index lock
+    bm25_index.add_tokens(doc_id, tokens, digest_stamp(doc_id.replace(':', ';'), document))
+
+def remove_document(doc_id):
+    bm25_index.remove(doc_id)
+
+# Batched add_document and remove_document, documents are (doc_id, document)
+def update_documents(documents, removed=()):
+    items = [(doc_id, preprocess(document), digest_stamp(doc_id.replace(':', ';'), document)) for doc_id, document in documents]
+    bm25_index.update(items, removed)
+
 def standardize(lst):
-    mean_val = statistics.mean(lst)
-    std_dev = statistics.pstdev(lst)
+    arr = np.asarray(lst, dtype=np.float64)
+    std_dev = arr.std()
     if std_dev == 0:
-        return [0]*len(lst)
-    return [(x - mean_val) / std_dev for x in lst]
+        return np.zeros(len(arr))
+    return (arr - arr.mean()) / std_dev
 
 def get_norm_bm25_scores(query, doc_id_list):
-    with lock:
-        if not doc_id_list:
-            return []
-        query = preprocess(query)[::-1]
-        query = list(set(query))
-        # Get scores
-        doc_index_list = [corpus_index[doc_id] for doc_id in doc_id_list]
-        scores = bm25.get_batch_scores(query, doc_index_list)
-        norm_scores = standardize(scores)
-        print('\n'.join([f"{b}-{a}" for a,b in zip(doc_id_list,norm_scores)]))
-        return norm_scores
-    
+    if not doc_id_list:
+        return []
+    query = preprocess(query)[::-1]
+    query = list(set(query))
+    # Get scores
+    scores = bm25_index.get_batch_scores(query, doc_id_list)
+    norm_scores = standardize(scores)
+    print('\n'.join([f"{b}-{a}" for a,b in zip(doc_id_list,norm_scores)]))
+    return norm_scores
+
 def get_avg_bm25_scores(query, doc_id_list):
-    with lock:
-        if not doc_id_list:
-            return []
-        query = preprocess(query)[::-1]
-        query = list(set(query))
-        # Get scores
-        doc_index_list = [corpus_index[doc_id] for doc_id in doc_id_list]
-        scores = bm25.get_batch_scores(query, doc_index_list)
-        avg_scores = [score/len(query) for score in scores]
-        print('\n'.join([f"{b}-{a}" for a,b in zip(doc_id_list,avg_scores)]))
-        return avg_scores
+    if not doc_id_list:
+        return []
+    query = preprocess(query)[::-1]
+    query = list(set(query))
+    # Get scores
+    scores = bm25_index.get_batch_scores(query, doc_id_list)
+    avg_scores = scores/max(len(query), 1) # a query of only stop words scores 0
+    print('\n'.join([f"{b}-{a}" for a,b in zip(doc_id_list,avg_scores)]))
+    return avg_scores
 
+def get_top_bm25_scores(query, k):
+    query = list(set(preprocess(query)))
+    return bm25_index.get_top_scores(query, k)
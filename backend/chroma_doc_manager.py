@@ -1,15 +1,14 @@
 import os
 import chromadb
-import datetime
-import threading
 from chromadb import EmbeddingFunction
 from chromadb.config import Settings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+import bm25_api
 from llm_utils import get_embeddings
-from settings import LANGUAGE_PREFERENCE
-
-ROOT_FOLDER = 'digests'
+from chroma_index import ROOT_FOLDER, prepare_index, active_chroma_path
+from document_cache import DocumentCache
+from rwlock import ReadWriteLock
+from settings import DOCUMENT_CACHE_SIZE, DOCUMENT_CACHE_PRELOAD
 
 # ---------------------------------------------------------------------------
 # Monkey patch ChromaDB's validate_where function to support string comparison
@@ -133,63 +132,120 @@ class DocumentFolder():
     
 class ChromaDocManager:
     def __init__(self):
-        self.lock = threading.Lock()
+        # Queries share the lock, changes to the collection and the digest folder take it alone.
+        # Embeddings are computed before taking it, so ingestion doesn't hold up queries.
+        self.lock = ReadWriteLock()
         # Initialize a persistent Chroma client
-        self.client = chromadb.PersistentClient(path=f'./{ROOT_FOLDER}/chroma', settings=Settings(anonymized_telemetry=False)) # this will not refresh on file change
+        # the folder reindex.py switched to last, a rebuild takes effect on the next start
+        self.client = chromadb.PersistentClient(path=active_chroma_path(), settings=Settings(anonymized_telemetry=False)) # this will not refresh on file change
         self.collection = self.client.get_or_create_collection(name='digests', embedding_function=EmbeddingFunction())
         self.folder = DocumentFolder(ROOT_FOLDER)
+        # Counts the committed changes, results of searches are only valid for the version they were made at
+        self.version = 0
+        # Documents read for retrieval, dropped whenever the document is saved or deleted
+        self.cache = DocumentCache(DOCUMENT_CACHE_SIZE)
+        if DOCUMENT_CACHE_PRELOAD:
+            self.preload()
+
+    def preload(self):
+        with self.lock.read():
+            for file in os.listdir(ROOT_FOLDER):
+                if self.cache.is_full():
+                    break
+                if bm25_api.is_digest_file(file):
+                    doc_id = file.replace(';', ':')
+                    self.cache.put(doc_id, self.folder.load(doc_id))
+        print("document cache preloaded: ", self.cache.stats())
+
+    def _prepare_index(self, document: str, doc_id: str, other_meta=None, chunk_size=100, chunk_overlap=0):
+        return prepare_index(document, doc_id, other_meta, chunk_size, chunk_overlap)
+
+    def _add_index(self, ids, chunks, metadatas, embeddings):
+        if chunks:
+            self.collection.upsert(ids=ids, documents=chunks, metadatas=metadatas, embeddings=embeddings)
 
-    # Define a function to add documents to the Chroma database
-    def _add_index(self, document: str, doc_id: str, other_meta=None, chunk_size=100, chunk_overlap=0):
-        assert ';' not in doc_id
-        # Split the document into chunks using the RecursiveCharacterTextSplitter
-        if LANGUAGE_PREFERENCE == 'Chinese':
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size//4, chunk_overlap=chunk_overlap, separators=['。','？'], keep_separator=False)
-        else:
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        chunks = text_splitter.split_text(document)
-        # Add each chunk to ChromaDB with associated doc_id and its index
-        ids = [f"{doc_id}_{i}" for i, _ in enumerate(chunks)]
-        # embed_chunks = get_embeddings(chunks)
-        doc_metadata = {"doc_id": doc_id}
-        if other_meta:
-            doc_metadata.update(other_meta)
-        if not "doc_time" in doc_metadata:
-            doc_metadata["doc_time"] = datetime.datetime.now().strftime("%Y-%m-%d")
-        self.collection.upsert(documents=chunks, ids=ids, metadatas=[doc_metadata]*len(chunks))
-        
     def add_document(self, document: str, doc_id: str, **kwargs):
-        with self.lock:
-            self._remove_index_by_doc_id(doc_id)
-            self._add_index(document, doc_id, **kwargs)
-            self.folder.save(doc_id, document)
+        ids, chunks, metadatas = self._prepare_index(document, doc_id, **kwargs)
+        embeddings = get_embeddings(chunks) if chunks else []
+        self.apply_changes([(doc_id, document, ids, chunks, metadatas, embeddings)])
+
+    # Commit the changes of many documents with one write lock, one upsert and one delete.
+    # documents are (doc_id, document, ids, chunks, metadatas, embeddings), made with _prepare_index
+    # and get_embeddings beforehand, and replace the documents of the same doc_id (the last one wins
+    # when a doc_id comes twice). The documents of remove_ids and of the notes in remove_names are removed.
+    # The new chunks are upserted first and only the chunks that are not part of them are deleted after,
+    # so a failing upsert leaves the old index in place.
+    def apply_changes(self, documents, remove_ids=(), remove_names=()):
+        documents = list({doc_id: (doc_id, *rest) for doc_id, *rest in documents}.values())
+        added = {doc_id for doc_id, *_ in documents}
+        with self.lock.write():
+            removed = set(remove_ids)
+            for doc_name in remove_names:
+                removed.update(metadata['doc_id'] for metadata in self._query_by_name(doc_name)["metadatas"])
+            old_ids = []
+            if removed or added:
+                old_ids = self.collection.get(where={"doc_id": {"$in": list(removed.union(added))}}, include=[])["ids"]
+            index = {}
+            for _, _, *chunks in documents:
+                for chunk in zip(*chunks):
+                    index[chunk[0]] = chunk # id, chunk, metadata, embedding
+            ids, chunks, metadatas, embeddings = (list(values) for values in zip(*index.values())) if index else ([], [], [], [])
+            self._add_index(ids, chunks, metadatas, embeddings)
+            stale = [chunk_id for chunk_id in old_ids if chunk_id not in index]
+            if stale:
+                self.collection.delete(ids=stale)
+            removed.difference_update(added)
+            for doc_id in removed:
+                self.folder.delete(doc_id)
+                self.cache.invalidate(doc_id)
+            for doc_id, document, *_ in documents:
+                self.folder.save(doc_id, document)
+                self.cache.invalidate(doc_id)
+        if removed:
+            print("removed: ", removed)
+        bm25_api.update_documents([(doc_id, document) for doc_id, document, *_ in documents], removed)
+        # only now both indexes have the changes, a search made before is cached under the old version
+        with self.lock.write():
+            self.version += 1
 
     def query_by_strings(self, strings, n_results):
-        with self.lock:
-            # Split the string into chunks for embedding
+        embeddings = get_embeddings(strings)
+        with self.lock.read():
             res = self.collection.query(
-                query_texts=strings,
+                query_embeddings=embeddings,
                 n_results=n_results,
                 include = [ "documents", "metadatas", "distances" ]
             )
             return res
         
-    def query_by_strings_with_time_range(self, strings, n_results, start_time, end_time):
-        with self.lock:
-            start_time_str = start_time.strftime("%Y-%m-%d")
-            end_time_str = end_time.strftime("%Y-%m-%d")
-            print("search range: ", start_time_str, end_time_str)
-            # Split the string into chunks for embedding
-            res = self.collection.query(
-                query_texts=strings,
-                n_results=n_results,
-                include = [ "documents", "metadatas", "distances" ],
-                where = {"$and":[{"doc_time":{"$gte": start_time_str}}, {"doc_time":{"$lte": end_time_str}}]}
-            )
-            return res
+    # Run several searches with one embedding request. A search is (query string, start_time, end_time),
+    # the times are None for a search without time range. Searches with the same range share one query.
+    # Returns {"documents", "metadatas", "distances"} per search, in the order of the searches.
+    def query_batch(self, searches, n_results):
+        embeddings = get_embeddings([query for query, _, _ in searches])
+        groups = {}
+        for i, (_, start_time, end_time) in enumerate(searches):
+            time_range = (start_time.strftime("%Y-%m-%d"), end_time.strftime("%Y-%m-%d")) if start_time else None
+            groups.setdefault(time_range, []).append(i)
+        results = [None]*len(searches)
+        with self.lock.read():
+            for time_range, indexes in groups.items():
+                kwargs = {}
+                if time_range:
+                    print("search range: ", *time_range)
+                    kwargs["where"] = {"$and":[{"doc_time":{"$gte": time_range[0]}}, {"doc_time":{"$lte": time_range[1]}}]}
+                res = self.collection.query(
+                    query_embeddings=[embeddings[i] for i in indexes],
+                    n_results=n_results,
+                    include = [ "documents", "metadatas", "distances" ],
+                    **kwargs
+                )
+                for j, i in enumerate(indexes):
+                    results[i] = {key: res[key][j] for key in ("documents", "metadatas", "distances")}
+        return results
 
     def query_by_doc_id(self, doc_id):
-        with self.lock:
+        with self.lock.read():
             res = self.collection.get(
                 where = {"doc_id":doc_id},
                 include = [ "documents", "metadatas" ]
@@ -204,31 +260,43 @@ class ChromaDocManager:
         return res
 
     def query_all(self):
-        with self.lock:
+        with self.lock.read():
             return self.collection.get(include = [ "documents", "metadatas" ])
     
     def _remove_index_by_doc_id(self, doc_id: str):
         self.collection.delete(where={"doc_id":doc_id})
 
     def remove_document(self, doc_id: str):
-        with self.lock:
-            self._remove_index_by_doc_id(doc_id)
-            self.folder.delete(doc_id)
+        self.apply_changes([], remove_ids=[doc_id])
 
     def remove_document_by_name(self, doc_name: str):
-        with self.lock:
-            res = self._query_by_name(doc_name)
-            print(res["metadatas"])
-            if res["metadatas"]:
-                ids = set([x['doc_id'] for x in res["metadatas"]])
-                print("to remove: ", ids)
-                for doc_id in ids:
-                    self._remove_index_by_doc_id(doc_id)
-                    self.folder.delete(doc_id)
+        self.apply_changes([], remove_names=[doc_name])
+
+    # The metadata of documents by doc_id (of their first chunk, all chunks have the same),
+    # documents that are not in the collection are left out
+    def get_metadata_by_ids(self, doc_ids):
+        if not doc_ids:
+            return {}
+        with self.lock.read():
+            res = self.collection.get(where={"doc_id": {"$in": list(doc_ids)}}, include=["metadatas"])
+        metadatas = {}
+        for metadata in res["metadatas"]:
+            metadatas.setdefault(metadata["doc_id"], metadata)
+        return metadatas
 
+    # None for a digest that is gone, e.g. deleted after the query that found it
     def get_document_by_ids(self, doc_ids):
-        with self.lock:
-            return [self.folder.load(doc_id) for doc_id in doc_ids]
+        documents = [self.cache.get(doc_id) for doc_id in doc_ids]
+        missing = [i for i, document in enumerate(documents) if document is None]
+        if missing:
+            with self.lock.read():
+                for i in missing:
+                    try:
+                        documents[i] = self.folder.load(doc_ids[i])
+                    except FileNotFoundError:
+                        continue
+                    self.cache.put(doc_ids[i], documents[i])
+        return documents
 
     # def update_document(self, document: str, doc_id: str):
     #     # Update the document in ChromaDB by first removing and then adding the new chunks
@@ -0,0 +1,44 @@
+import os
+import datetime
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from token_counter import count_tokens
+from settings import LANGUAGE_PREFERENCE
+
+# How digests are stored in Chroma: their chunks and the database folder in use. Apart from
+# chroma_doc_manager, which opens the database when imported, so reindex.py can rebuild a broken one.
+
+ROOT_FOLDER = 'digests'
+ACTIVE_CHROMA_FILE = os.path.join(ROOT_FOLDER, "chroma_active") # name of the database folder in use, "chroma" without it
+
+def active_chroma_path():
+    try:
+        with open(ACTIVE_CHROMA_FILE, encoding='utf-8') as f:
+            name = f.read().strip()
+    except OSError:
+        name = ""
+    return os.path.join(ROOT_FOLDER, name or "chroma")
+
+# Switch to the database in ROOT_FOLDER/name, a crash leaves either the old or the new one in use
+def set_active_chroma(name):
+    with open(ACTIVE_CHROMA_FILE + ".tmp", "w", encoding='utf-8') as f:
+        f.write(name)
+    os.replace(ACTIVE_CHROMA_FILE + ".tmp", ACTIVE_CHROMA_FILE)
+
+# Split a document into the chunks stored in the Chroma database
+def prepare_index(document: str, doc_id: str, other_meta=None, chunk_size=100, chunk_overlap=0):
+    assert ';' not in doc_id
+    # Split the document into chunks using the RecursiveCharacterTextSplitter
+    if LANGUAGE_PREFERENCE == 'Chinese':
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size//4, chunk_overlap=chunk_overlap, separators=['。','？'], keep_separator=False)
+    else:
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    chunks = text_splitter.split_text(document)
+    # Add each chunk to ChromaDB with associated doc_id and its index
+    ids = [f"{doc_id}_{i}" for i, _ in enumerate(chunks)]
+    doc_metadata = {"doc_id": doc_id, "n_tokens": count_tokens(document)} # counted once here instead of at every search
+    if other_meta:
+        doc_metadata.update(other_meta)
+    if not "doc_time" in doc_metadata:
+        doc_metadata["doc_time"] = datetime.datetime.now().strftime("%Y-%m-%d")
+    return ids, chunks, [doc_metadata]*len(chunks)
@@ -0,0 +1,219 @@
+import re
+import calendar
+from datetime import datetime
+from functools import lru_cache
+
+from dateutil.relativedelta import relativedelta
+from dateparser import parse
+from dateparser.search import search_dates
+from dateparser.languages.loader import default_loader
+
+from settings import LANGUAGE_PREFERENCE
+
+# Dictionary containing language codes and keywords for each supported language
+language_dict = {
+    'English': {'code': 'en', 'month': 'month', 'week': 'week'},
+    'Chinese': {'code': 'zh', 'month': '月', 'week': '周'},
+    'German': {'code': 'de', 'month': 'monat', 'week': 'woche'},
+    'French': {'code': 'fr', 'month': 'mois', 'week': 'semaine'},
+    'Spanish': {'code': 'es', 'month': 'mes', 'week': 'semana'},
+    'Portuguese': {'code': 'pt', 'month': 'mês', 'week': 'semana'},
+    'Italian': {'code': 'it', 'month': 'mese', 'week': 'settimana'},
+    'Dutch': {'code': 'nl', 'month': 'maand', 'week': 'week'},
+    'Czech': {'code': 'cs', 'month': 'měsíc', 'week': 'týden'},
+    'Polish': {'code': 'pl', 'month': 'miesiąc', 'week': 'tydzień'},
+    'Russian': {'code': 'ru', 'month': 'месяц', 'week': 'неделя'},
+    'Arabic': {'code': 'ar', 'month': 'شهر', 'week': 'أسبوع'}
+}
+
+language_list = ['en'] if LANGUAGE_PREFERENCE == "English" else [language_dict[LANGUAGE_PREFERENCE]['code'], 'en']
+
+MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july', 'august', 'september', 'october', 'november', 'december']
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+UNITS = ['year', 'month', 'week', 'day', 'hour', 'minute', 'second']
+RELATIVE_KEY = re.compile(r'^(?:(in) )?(\d+|\\1) (decade|year|month|week|day|hour|minute|second)s?(?: ago)?$')
+
+# ---------------------------------------------------------------------------
+# Precompiled recognizer for the common date expressions of search queries.
+# The vocabulary (month names, "yesterday", "3 days ago", ...) comes from dateparser's own
+# locale data for the preferred language and English, so results agree with dateparser,
+# which is only called for queries the recognizer can't handle but that look like they
+# contain a date.
+# ---------------------------------------------------------------------------
+def _alternation(words):
+    return '|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+def _build_recognizer(codes, word_boundaries):
+    month_names = {}
+    neighbours = set() # other words dateparser may read together with a date
+    joiners, in_words = set(), set() # words dateparser joins to a neighbouring date ("at", "the", "in", ...)
+    relatives = {} # phrase -> (n, unit), n negative for the past
+    relative_regexes = [] # (regex, sign, unit)
+    vocabulary = set()
+    for code in codes:
+        info = default_loader.get_locale(code).info
+        for number, month in enumerate(MONTHS, 1):
+            for name in info.get(month, []):
+                if len(name) >= 3 or not word_boundaries:
+                    month_names[name.lower()] = number
+        for key in MONTHS + WEEKDAYS + UNITS + ['ago', 'am', 'pm']:
+            vocabulary.update(word.lower() for word in info.get(key, []) if len(word) >= 3 or not word_boundaries)
+        for simplification in info.get('simplifications', []): # "noon", "one", "later", ...
+            for key in simplification:
+                neighbours.update(word.lower() for word in re.findall(r'[^\W\d_]{3,}', key))
+        in_words.update(word.lower() for word in info.get('in', []))
+        joiners.update(word.lower() for word in info.get('skip', []) + info.get('in', []) if len(word) >= 2 and word.isalpha())
+        for key, phrases in info.get('relative-type', {}).items():
+            match = RELATIVE_KEY.match(key)
+            vocabulary.update(phrase.lower() for phrase in phrases)
+            if match:
+                sign = 1 if match.group(1) else -1
+                for phrase in phrases:
+                    relatives[phrase.lower()] = (sign * int(match.group(2)), match.group(3))
+        for key, patterns in info.get('relative-type-regex', {}).items():
+            match = RELATIVE_KEY.match(key)
+            if match:
+                sign = 1 if match.group(1) else -1
+                relative_regexes += [(pattern.replace('(\\d+[.,]?\\d*)', r'(\d+)'), sign, match.group(3)) for pattern in patterns]
+
+    months = _alternation(month_names)
+    rules = [ # most specific first, the first alternative that matches at a position wins
+        ('ymd', r'(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})'),
+        ('mdy', rf'({months})\.?\s+(\d{{1,2}})(?:st|nd|rd|th)?,?\s+(\d{{4}})'),
+        ('dmy', rf'(\d{{1,2}})(?:st|nd|rd|th)?\.?\s+(?:of\s+)?({months})\.?,?\s+(\d{{4}})'),
+        ('my', rf'({months})\.?,?\s+(\d{{4}})'),
+    ]
+    if 'zh' in codes: # dateparser only reads these with the Chinese locale
+        rules[1:1] = [('ymd', r'(\d{4})年(\d{1,2})月(\d{1,2})日')]
+        rules.append(('ym', r'(\d{4})年(\d{1,2})月'))
+    rules += [('ago', pattern) for pattern, _, _ in relative_regexes]
+    rules += [('relative', f'({_alternation(relatives)})')]
+    rules += [('m', f'({months})'), ('y', r'((?:19|20)\d{2})')]
+    before, after = (r'(?<!\w)', r'(?!\w)') if word_boundaries else ('', '')
+    # every rule gets its own named group, its own groups are counted from there
+    parts, groups = [], []
+    for i, (kind, pattern) in enumerate(rules):
+        parts.append(f'{before}(?P<r{i}>{pattern}){after}')
+        groups.append((kind, re.compile(pattern).groups))
+    regex = re.compile('|'.join(parts), re.IGNORECASE)
+    vocabulary_regex = re.compile(rf'\d|{before}(?:{_alternation(vocabulary)}){after}', re.IGNORECASE)
+    neighbour_regex = re.compile(rf'\d|^(?:{_alternation(vocabulary | neighbours | joiners)})$', re.IGNORECASE)
+    return regex, groups, month_names, relatives, relative_regexes, vocabulary_regex, joiners, in_words, neighbour_regex
+
+(_regex, _groups, _month_names, _relatives, _relative_regexes, _vocabulary_regex,
+ _joiners, _in_words, _neighbour_regex) = _build_recognizer(language_list, LANGUAGE_PREFERENCE != 'Chinese')
+
+_WORD_BEFORE = re.compile(r'(\w+)\s+$')
+_WORD_AFTER = re.compile(r'\s+(\w+)')
+_NEIGHBOUR_BEFORE = re.compile(r'(\w+)\W*$')
+_NEIGHBOUR_AFTER = re.compile(r'\W*(\w+)')
+_NUMBER_BEFORE = re.compile(r'\d[-/.,:]*$')
+_NUMBER_AFTER = re.compile(r'[-/.,:]*\d')
+
+def _month_day(year, month, day):
+    return min(day, calendar.monthrange(year, month)[1])
+
+def _resolve(match, now, prefer):
+    # prefer is None for the date dateparser.search_dates would return, else 'first'/'last'
+    # like PREFER_DAY_OF_MONTH and PREFER_MONTH_OF_YEAR of dateparser.parse
+    name = match.lastgroup
+    i = int(name[1:])
+    kind = _groups[i][0]
+    start = match.re.groupindex[name]
+    values = match.groups()[start:start + _groups[i][1]]
+    try:
+        if kind == 'ymd':
+            return datetime(int(values[0]), int(values[1]), int(values[2]))
+        if kind == 'mdy':
+            return datetime(int(values[2]), _month_names[values[0].lower()], int(values[1]))
+        if kind == 'dmy':
+            return datetime(int(values[2]), _month_names[values[1].lower()], int(values[0]))
+        if kind in ('my', 'ym', 'm'):
+            if kind == 'my':
+                month, year = _month_names[values[0].lower()], int(values[1])
+            elif kind == 'ym':
+                year, month = int(values[0]), int(values[1])
+            else:
+                month = _month_names[values[0].lower()]
+                year = now.year if month <= now.month else now.year - 1 # prefer dates from the past
+            day = {'first': 1, 'last': 31, None: now.day}[prefer]
+            return datetime(year, month, _month_day(year, month, day))
+        if kind == 'y':
+            year = int(values[0])
+            month, day = {'first': (1, 1), 'last': (12, 31), None: (now.month, now.day)}[prefer]
+            return datetime(year, month, _month_day(year, month, day))
+        if kind == 'relative':
+            n, unit = _relatives[values[0].lower()]
+        else: # ago
+            text = match.group(name)
+            for pattern, sign, unit in _relative_regexes:
+                relative_match = re.fullmatch(pattern, text, re.IGNORECASE)
+                if relative_match:
+                    n = sign * int(relative_match.group(1))
+                    break
+            else:
+                return None
+        if unit == 'decade':
+            n, unit = n * 10, 'year'
+        return now + relativedelta(**{unit + 's': n})
+    except (ValueError, OverflowError): # e.g. 2024-13-45
+        return None
+
+# The date string dateparser would find around the match, with the joiner words next to it, or
+# None if the text around it could change how dateparser reads it
+def _date_span(text, match):
+    start, end = match.span()
+    if _NUMBER_BEFORE.search(text, 0, start) or _NUMBER_AFTER.match(text, end): # part of 12/05/2023, 1.2023, ...
+        return None
+    absorbed = set()
+    while (word := _WORD_BEFORE.search(text, 0, start)) and word.group(1).lower() in _joiners:
+        absorbed.add(word.group(1).lower())
+        start = word.start(1)
+    while (word := _WORD_AFTER.match(text, end)) and word.group(1).lower() in _joiners:
+        absorbed.add(word.group(1).lower())
+        end = word.end(1)
+    if absorbed & _in_words and _groups[int(match.lastgroup[1:])][0] in ('relative', 'ago'):
+        return None # "in 3 days ago" is a future date to dateparser
+    for neighbour in (_NEIGHBOUR_BEFORE.search(text, 0, start), _NEIGHBOUR_AFTER.match(text, end)):
+        if neighbour and _neighbour_regex.search(neighbour.group(1)):
+            return None # dateparser may join them ("the year 2023", "june and july", "yesterday, 3pm")
+    return text[start:end]
+
+# [] for a text without dates, [(date string, datetime)] for one the recognizer can read like
+# dateparser, None to let dateparser decide about the whole string, e.g. when it has several dates
+def _recognize(text, now, prefer=None):
+    matches = list(_regex.finditer(text))
+    if not matches:
+        return []
+    if len(matches) > 1:
+        return None
+    date_str = _date_span(text, matches[0])
+    date = _resolve(matches[0], now, prefer) if date_str else None
+    if date is None:
+        return None
+    return [(date_str, date)]
+
+@lru_cache(maxsize=1024)
+def _search_query_dates(query_str, today):
+    dates = _recognize(query_str, datetime.now())
+    if dates:
+        return dates
+    if dates is not None and not _vocabulary_regex.search(query_str):
+        return None # nothing that looks like a date, don't ask dateparser
+    return search_dates(query_str, languages=language_list, settings={"PREFER_DATES_FROM":"past"})
+
+# dateparser.search.search_dates(query_str) for the preferred languages: a list of (date string,
+# datetime) or None. Compared with it by benchmarks/check_date_parity.py
+def search_query_dates(query_str):
+    return _search_query_dates(query_str, datetime.now().date())
+
+@lru_cache(maxsize=1024)
+def _parse_date(date_str, prefer, today):
+    dates = _recognize(date_str.strip(), datetime.now(), prefer)
+    if dates and dates[0][0] == date_str.strip():
+        return dates[0][1]
+    return parse(date_str, languages=language_list, settings={"PREFER_DATES_FROM":"past", "PREFER_MONTH_OF_YEAR": prefer, 'PREFER_DAY_OF_MONTH': prefer})
+
+# dateparser.parse(date_str) with PREFER_MONTH_OF_YEAR and PREFER_DAY_OF_MONTH set to prefer
+def parse_date(date_str, prefer):
+    return _parse_date(date_str, prefer, datetime.now().date())
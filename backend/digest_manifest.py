@@ -0,0 +1,45 @@
+import os
+import json
+import hashlib
+import threading
+
+MANIFEST_PATH = os.path.join("digests", "manifest.json")
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+# What the digests of each source file were made from: the hash of the file and, for notes,
+# the hash of every section by the doc_id of its digest. A file with the same hash doesn't
+# need to be digested again, and neither does a section with the same hash.
+# Written as a whole to a new file that replaces the old one, so a crash leaves one of the two.
+class DigestManifest():
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {} # path of the source file -> {"hash": file hash, "sections": {doc_id: section hash}}
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.files = json.load(f)
+
+    def get(self, file_path):
+        with self.lock:
+            return self.files.get(file_path)
+
+    def set(self, file_path, file_hash, sections=None):
+        with self.lock:
+            self.files[file_path] = {"hash": file_hash, "sections": sections or {}}
+
+    def remove(self, file_path):
+        with self.lock:
+            self.files.pop(file_path, None)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = json.dumps(self.files, ensure_ascii=False)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding='utf-8') as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,59 @@
+import sys
+import threading
+from collections import OrderedDict
+
+# Digest documents by doc_id, least recently used dropped first when the documents together
+# take more than max_bytes. The owner keeps it in step with the digest folder.
+class DocumentCache():
+    def __init__(self, max_bytes=64*1024*1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.documents = OrderedDict() # doc_id -> document, most recently used last
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, doc_id):
+        with self.lock:
+            document = self.documents.get(doc_id)
+            if document is None:
+                self.misses += 1
+                return None
+            self.documents.move_to_end(doc_id)
+            self.hits += 1
+            return document
+
+    def put(self, doc_id, document):
+        size = sys.getsizeof(document)
+        with self.lock:
+            self._drop(doc_id)
+            if size > self.max_bytes:
+                return
+            self.documents[doc_id] = document
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                self._drop(next(iter(self.documents)))
+
+    def invalidate(self, doc_id):
+        with self.lock:
+            self._drop(doc_id)
+
+    def is_full(self):
+        return self.n_bytes >= self.max_bytes
+
+    def _drop(self, doc_id):
+        document = self.documents.pop(doc_id, None)
+        if document is not None:
+            self.n_bytes -= sys.getsizeof(document)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "documents": len(self.documents),
+                "memory_bytes": self.n_bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,98 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from settings import EMBEDDING_MODEL_NAME, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_PATH
+
+# Embeddings keyed by model name and a hash of the text: an LRU in memory in front of
+# an SQLite table that survives restarts. Vectors are stored as float32 blobs.
+class EmbeddingCache():
+    def __init__(self, model_name, path=None, max_size=10000):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.memory = OrderedDict() # key -> float32 vector, most recently used last
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT, key TEXT, vector BLOB, PRIMARY KEY (model, key))")
+            self.db.commit()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        keys = [self.key(text) for text in texts]
+        vectors = [None] * len(texts)
+        with self.lock:
+            for i, key in enumerate(keys):
+                vector = self.memory.get(key)
+                if vector is not None:
+                    self.memory.move_to_end(key)
+                    vectors[i] = vector
+                    self.memory_hits += 1
+            missing = [i for i, vector in enumerate(vectors) if vector is None]
+            if missing and self.db:
+                found = self._load([keys[i] for i in missing])
+                for i in missing:
+                    vector = found.get(keys[i])
+                    if vector is not None:
+                        vectors[i] = vector
+                        self.disk_hits += 1
+                        self._remember(keys[i], vector)
+            self.misses += sum(1 for vector in vectors if vector is None)
+        return vectors
+
+    # returns the vectors as stored, float32 arrays
+    def put_many(self, texts, vectors):
+        vectors = [np.asarray(vector, dtype=np.float32) for vector in vectors]
+        rows = []
+        with self.lock:
+            for text, vector in zip(texts, vectors):
+                key = self.key(text)
+                self._remember(key, vector)
+                rows.append((self.model_name, key, vector.tobytes()))
+            if self.db:
+                self.db.executemany("INSERT OR REPLACE INTO embeddings (model, key, vector) VALUES (?, ?, ?)", rows)
+                self.db.commit()
+        return vectors
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def _load(self, keys):
+        found = {}
+        for start in range(0, len(keys), 500): # stay below SQLite's limit of query parameters
+            batch = keys[start:start + 500]
+            rows = self.db.execute(
+                f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(batch))})",
+                [self.model_name, *batch])
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def stats(self):
+        with self.lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "memory_size": len(self.memory),
+            }
+
+embedding_cache = EmbeddingCache(EMBEDDING_MODEL_NAME, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_SIZE)
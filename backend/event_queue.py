@@ -0,0 +1,63 @@
+import heapq
+import threading
+import time
+
+# File events by path, handed out once no new event came for the path for `debounce` seconds.
+# A new event of a waiting path replaces the old one and starts its window again, so a burst of
+# saves is handled once and the last event decides: deleted if the file is gone in the end
+# (a move is a delete of the source and a create of the destination), created/modified otherwise.
+class CoalescingQueue():
+    def __init__(self, debounce=2.):
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        self.events = {} # path -> (due time, seq, event_type)
+        self.heap = [] # (due time, seq, path), entries replaced by a newer event are skipped
+        self.seq = 0
+        self.received = 0
+        self.coalesced = 0
+
+    def put(self, path, event_type):
+        with self.condition:
+            self.seq += 1
+            self.received += 1
+            if path in self.events:
+                self.coalesced += 1
+            due = time.monotonic() + self.debounce
+            self.events[path] = (due, self.seq, event_type)
+            heapq.heappush(self.heap, (due, self.seq, path))
+            self.condition.notify_all()
+
+    def move(self, src_path, dest_path):
+        with self.condition:
+            self.put(src_path, "on_deleted")
+            self.put(dest_path, "on_created")
+
+    # Wait for the next settled event and return (path, event_type), or None after timeout seconds
+    def get(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while self.heap and self.events.get(self.heap[0][2], (None, None))[1] != self.heap[0][1]:
+                    heapq.heappop(self.heap) # replaced by a newer event
+                wait = None
+                if self.heap:
+                    due, _, path = self.heap[0]
+                    if due <= now:
+                        heapq.heappop(self.heap)
+                        _, _, event_type = self.events.pop(path)
+                        return path, event_type
+                    wait = due - now
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self.condition.wait(wait)
+
+    def __len__(self):
+        with self.condition:
+            return len(self.events)
+
+    def stats(self):
+        with self.condition:
+            return {"waiting": len(self.events), "received": self.received, "coalesced": self.coalesced}
@@ -1,96 +1,60 @@
-import os
 import threading
 import time
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-from datetime import datetime, timedelta
 
-from llm_utils import digest_simple, digest_markdown
 from chroma_doc_manager import doc_manager
 from bm25_api import update_corpus
+from ingestion import IngestionPipeline
+from event_queue import CoalescingQueue
+from scheduler import indexing_scheduler
+from settings import FILE_DEBOUNCE_SECONDS
 
-modified_files = {}
+file_queue = CoalescingQueue(FILE_DEBOUNCE_SECONDS)
+
+def enqueue(path, event_type):
+    indexing_scheduler.enqueued(path)
+    file_queue.put(path, event_type)
 
 class MyEventHandler(FileSystemEventHandler):
     def on_modified(self, event):
         print(f"Change: {event.src_path}")
         if event.src_path.endswith('.md'):
-            modified_files[event.src_path] = "on_modified"
+            enqueue(event.src_path, "on_modified")
 
     def on_created(self, event):
         print(f"Add: {event.src_path}")
         if event.src_path.endswith('.md'):
-            modified_files[event.src_path] = "on_created"
+            enqueue(event.src_path, "on_created")
 
     def on_deleted(self, event):
         print(f"Delete: {event.src_path}")
         if event.src_path.endswith('.md'):
-            modified_files[event.src_path] = "on_deleted"
+            enqueue(event.src_path, "on_deleted")
 
     def on_moved(self, event):
         print(f"Move: {event.src_path} to {event.dest_path}")
-        if event.src_path.endswith('.md'):
-            modified_files[event.src_path] = "on_deleted"
-        if event.dest_path.endswith('.md'):
-            modified_files[event.dest_path] = "on_created"
+        if event.src_path.endswith('.md') and event.dest_path.endswith('.md'):
+            indexing_scheduler.enqueued(event.src_path)
+            indexing_scheduler.enqueued(event.dest_path)
+            file_queue.move(event.src_path, event.dest_path)
+        elif event.src_path.endswith('.md'):
+            enqueue(event.src_path, "on_deleted")
+        elif event.dest_path.endswith('.md'): # editors that save to a temporary file and rename it
+            enqueue(event.dest_path, "on_created")
 
 class UpdateThread(threading.Thread):
-    def __init__(self, server_state, *args, **kwargs):
+    def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.server_state = server_state
         update_corpus() # probably better start in memory server
+        self.pipeline = IngestionPipeline(doc_manager)
+        indexing_scheduler.register("file_queue", file_queue.stats)
+        indexing_scheduler.register("ingestion", self.pipeline.stats)
 
     def run(self):
         while True:
-            if not modified_files:  # If there are no modified files
-                time.sleep(60)  # Wait for a minute before checking again
-                continue  # Skip the rest of the loop and start the next iteration
-
-            now = datetime.now()
-            diff = timedelta(seconds=30)
-            if self.server_state["last_use"] and now - self.server_state["last_use"] < diff:  # If the server is used in recently 5 mins
-                print("Server is used lately")
-                time.sleep(10)  # Wait for a minute before checking again
-                continue  # Skip the rest of the loop and start the next iteration
-            
-            path, event_type = next(iter(modified_files.items()))  # Get the first item
-            del modified_files[path]  # Remove the handled file
-            print(f"To handle {event_type}: {path}")
-            try:
-                file = os.path.basename(path)
-                title = file.rsplit(".", 1)[0].replace(';', ':')
-                if "notes" in path:
-                    doc_manager.remove_document_by_name(title)
-                else:
-                    doc_manager.remove_document(title)
-
-                if event_type in ["on_created", "on_modified"]:
-                    if "notes" in path:
-                        time_str = str(now)[0:10]
-                        print(time_str)
-                        digests = digest_markdown(title, path)
-                        print(digests)
-                        for headers, summary in digests:
-                            doc_id = "Note of " + headers
-                            doc_manager.add_document(summary, doc_id, other_meta = {"doc_time": time_str, "doc_name":title})
-                    else:
-                        summary, tag = digest_simple(title, path)
-                        digest = f"{title}\n{summary}"
-                        if len(tag):
-                            digest += '\nOpinion: ' + tag
-                        print(digest)
-                        if title.startswith("Conversation"):
-                            time_str = title.rsplit("on", 1)[1][1:11]
-                            doc_manager.add_document(digest, title, other_meta = {"doc_time": time_str})
-                        else:
-                            print("Warning: Unformatted doc ", title)
-            except Exception:
-                import traceback
-                traceback.print_exc()
-                print(f"error handling {event_type}: {path}")
-
-            update_corpus()
-            
+            path, event_type = file_queue.get()  # Wait until a file has settled
+            self.pipeline.submit(path, event_type) # waits while the pipeline is full, the scheduler decides when its steps run
 
 class WatchdogThread(threading.Thread):
     def __init__(self, chat_path, note_path, *args, **kwargs):
@@ -0,0 +1,281 @@
+import os
+import queue
+import threading
+import time
+import traceback
+from datetime import datetime
+
+from llm_utils import digest_simple_text, split_markdown, digest_sections, get_embeddings
+from digest_manifest import DigestManifest, content_hash
+from scheduler import indexing_scheduler
+from settings import INGEST_WORKERS, INGEST_QUEUE_SIZE, INGEST_COMMIT_BATCH, DIGEST_MAX_CONCURRENCY
+
+STAGES = ["read", "digest", "chunk", "embed", "index"]
+
+# split_markdown gives repeated headings the same header path, the later sections get " (2)", " (3)"...
+# so every section has its own doc_id and manifest entry
+def number_repeated(sections):
+    used = set()
+    numbered = []
+    for headers, content in sections:
+        unique, n = headers, 1
+        while unique in used:
+            n += 1
+            unique = f"{headers} ({n})"
+        used.add(unique)
+        numbered.append((unique, content))
+    return numbered
+
+class IngestJob():
+    def __init__(self, path, event_type, seq):
+        self.path = path
+        self.event_type = event_type
+        self.seq = seq
+        self.time_str = datetime.now().strftime("%Y-%m-%d")
+        file = os.path.basename(path)
+        self.title = file.rsplit(".", 1)[0].replace(';', ':')
+        self.is_note = "notes" in path
+        self.text = None
+        self.file_hash = None
+        self.unchanged = False
+        self.sections = {} # doc_id -> hash of the note section it is the digest of
+        # without a manifest entry every document made from the file is replaced
+        self.remove_ids = [] if self.is_note else [self.title]
+        self.remove_names = [self.title] if self.is_note else []
+        self.documents = [] # (doc_id, digest, other_meta)
+        self.prepared = [] # (doc_id, digest, ids, chunks, metadatas, embeddings)
+        self.outcome = None # "committed" or "superseded" once the index stage is done with it, else it failed
+
+    def __repr__(self):
+        return f"{self.event_type}: {self.path}"
+
+# Handles changed files in stages connected by bounded queues:
+#   read -> digest (LLM) -> chunk -> embed -> index
+# Every stage but index has its own pool of worker threads, so many files can wait for the LLM
+# at once while others are embedded. A full queue blocks the stage in front of it, up to submit.
+# The index stage is a single thread that commits whatever is ready in one batch to Chroma,
+# the digest folder and BM25, so the indexes change under one write lock per batch.
+# Files whose content is the same as in the manifest stop after read, and of a changed note only
+# the changed sections are summarized and indexed again, the digests of the others stay as they are.
+# Each unit of work (a stage of a file, a round of section summaries, a commit) is a step of the
+# scheduler, which holds it back while chat requests have priority.
+class IngestionPipeline():
+    def __init__(self, doc_manager, workers=INGEST_WORKERS, queue_size=INGEST_QUEUE_SIZE, commit_batch=INGEST_COMMIT_BATCH,
+                 digest_note=digest_sections, digest_chat=digest_simple_text, embed=get_embeddings, manifest=None, scheduler=indexing_scheduler):
+        self.doc_manager = doc_manager
+        self.commit_batch = commit_batch
+        self.digest_note = digest_note
+        self.digest_chat = digest_chat
+        self.embed = embed
+        self.manifest = manifest or DigestManifest()
+        self.scheduler = scheduler
+        self.queues = {stage: queue.Queue(maxsize=queue_size) for stage in STAGES}
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.seq = 0
+        self.latest = {} # path -> seq of its latest job, older jobs of the path are not committed
+        self.pending = 0
+        self.stats_dict = {"submitted": 0, "committed": 0, "unchanged": 0, "superseded": 0, "failed": 0, "batches": 0,
+                           "sections_digested": 0, "sections_reused": 0}
+        self.busy = {stage: 0. for stage in STAGES} # seconds spent in each stage
+        self.threads = []
+        for stage, next_stage in zip(STAGES, STAGES[1:]):
+            for i in range(workers.get(stage, 1)):
+                self.threads.append(threading.Thread(target=self._work, args=(stage, next_stage), name=f"ingest-{stage}-{i}", daemon=True))
+        self.threads.append(threading.Thread(target=self._commit_loop, name="ingest-index", daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    # Queue a file event, blocks while the pipeline is full
+    def submit(self, path, event_type):
+        with self.lock:
+            self.seq += 1
+            self.latest[path] = self.seq
+            self.pending += 1
+            self.stats_dict["submitted"] += 1
+            job = IngestJob(path, event_type, self.seq)
+        print(f"To handle {job}")
+        self.queues["read"].put(job)
+
+    # Wait until every submitted file is committed or failed
+    def join(self, timeout=None):
+        with self.idle:
+            return self.idle.wait_for(lambda: self.pending == 0, timeout)
+
+    def stats(self):
+        with self.lock:
+            return {**self.stats_dict, "pending": self.pending,
+                    "queued": {stage: q.qsize() for stage, q in self.queues.items()},
+                    "busy_seconds": dict(self.busy)}
+
+    def _finish(self, n, key):
+        with self.lock:
+            self.pending -= n
+            self.stats_dict[key] += n
+            if self.pending == 0:
+                self.idle.notify_all()
+
+    # finish a job that leaves the pipeline before the index stage
+    def _drop(self, job, key):
+        with self.lock:
+            latest = self.latest.get(job.path) == job.seq
+            if latest:
+                del self.latest[job.path]
+        if latest:
+            self.scheduler.indexed(job.path)
+        self._finish(1, key)
+
+    def _work(self, stage, next_stage):
+        handle = getattr(self, "_" + stage)
+        while True:
+            job = self.queues[stage].get()
+            start = time.perf_counter()
+            try:
+                if job.event_type == "on_deleted":
+                    pass
+                elif stage == "digest": # takes a step per LLM round
+                    handle(job)
+                else:
+                    with self.scheduler.step():
+                        handle(job)
+            except Exception:
+                traceback.print_exc()
+                print(f"error handling {job} in {stage}")
+                self._drop(job, "failed")
+                continue
+            finally:
+                with self.lock:
+                    self.busy[stage] += time.perf_counter() - start
+            if job.unchanged:
+                print(f"{job.path} is unchanged")
+                self._drop(job, "unchanged")
+                continue
+            self.queues[next_stage].put(job)
+
+    def _read(self, job):
+        with open(job.path, encoding='utf-8') as f:
+            job.text = f.read()
+        job.file_hash = content_hash(job.text)
+        entry = self.manifest.get(job.path)
+        job.unchanged = entry is not None and entry["hash"] == job.file_hash
+
+    def _digest(self, job):
+        if job.is_note:
+            sections = number_repeated(split_markdown(job.title, job.text))
+            job.sections = {"Note of " + headers: content_hash(content) for headers, content in sections}
+            entry = self.manifest.get(job.path)
+            if entry:
+                # keep the digests of unchanged sections, the changed ones are replaced when committed
+                job.remove_ids = [doc_id for doc_id in entry["sections"] if doc_id not in job.sections]
+                job.remove_names = []
+                sections = [(headers, content) for headers, content in sections
+                            if entry["sections"].get("Note of " + headers) != job.sections["Note of " + headers]]
+            with self.lock:
+                self.stats_dict["sections_digested"] += len(sections)
+                self.stats_dict["sections_reused"] += len(job.sections) - len(sections)
+            digests = []
+            for start in range(0, len(sections), DIGEST_MAX_CONCURRENCY):
+                with self.scheduler.step():
+                    digests += self.digest_note(sections[start:start + DIGEST_MAX_CONCURRENCY])
+            print(digests)
+            job.documents = [("Note of " + headers, summary, {"doc_time": job.time_str, "doc_name": job.title}) for headers, summary in digests]
+        else:
+            with self.scheduler.step():
+                summary, tag = self.digest_chat(job.title, job.text)
+            digest = f"{job.title}\n{summary}"
+            if len(tag):
+                digest += '\nOpinion: ' + tag
+            print(digest)
+            if job.title.startswith("Conversation"):
+                time_str = job.title.rsplit("on", 1)[1][1:11]
+                job.documents = [(job.title, digest, {"doc_time": time_str})]
+            else:
+                print("Warning: Unformatted doc ", job.title)
+
+    def _chunk(self, job):
+        job.prepared = [(doc_id, document, *self.doc_manager._prepare_index(document, doc_id, other_meta=other_meta))
+                        for doc_id, document, other_meta in job.documents]
+
+    def _embed(self, job):
+        # all chunks of the file in one request
+        chunks = [chunk for _, _, _, doc_chunks, _ in job.prepared for chunk in doc_chunks]
+        embeddings = iter(self.embed(chunks) if chunks else [])
+        job.prepared = [(doc_id, document, ids, doc_chunks, metadatas, [next(embeddings) for _ in doc_chunks])
+                        for doc_id, document, ids, doc_chunks, metadatas in job.prepared]
+
+    def _commit_loop(self):
+        while True:
+            batch = [self.queues["index"].get()]
+            while len(batch) < self.commit_batch:
+                try:
+                    batch.append(self.queues["index"].get_nowait())
+                except queue.Empty:
+                    break
+            start = time.perf_counter()
+            try:
+                with self.scheduler.step():
+                    self._commit(batch)
+            except Exception: # the jobs not committed yet count as failed, the thread goes on with the next batch
+                traceback.print_exc()
+                print(f"error committing {batch}")
+            finally:
+                with self.lock:
+                    self.busy["index"] += time.perf_counter() - start
+            self._settle(batch)
+
+    def _apply(self, jobs):
+        remove_ids, remove_names, documents = [], [], []
+        for job in jobs:
+            remove_ids += job.remove_ids
+            remove_names += job.remove_names
+            documents += job.prepared
+        self.doc_manager.apply_changes(documents, remove_ids, remove_names)
+
+    def _commit(self, batch):
+        with self.lock:
+            # a file changed again while its job was in the pipeline: only its latest job counts
+            jobs = {job.path: job for job in batch if self.latest.get(job.path) == job.seq}
+        for job in batch:
+            if jobs.get(job.path) is not job:
+                job.outcome = "superseded"
+        jobs = list(jobs.values())
+        try:
+            self._apply(jobs)
+            committed = jobs
+        except Exception:
+            traceback.print_exc()
+            print(f"error committing {jobs}")
+            committed = []
+            if len(jobs) > 1: # one bad file doesn't fail the others
+                for job in jobs:
+                    try:
+                        self._apply([job])
+                        committed.append(job)
+                    except Exception:
+                        traceback.print_exc()
+                        print(f"error committing {job}")
+        for job in committed:
+            if job.event_type == "on_deleted":
+                self.manifest.remove(job.path)
+            else:
+                self.manifest.set(job.path, job.file_hash, job.sections)
+        if committed:
+            self.manifest.save()
+        for job in committed:
+            job.outcome = "committed"
+
+    # Count the jobs of a committed batch by their outcome and let the paths they were the latest job of go
+    def _settle(self, batch):
+        counts = {}
+        for job in batch:
+            key = job.outcome or "failed"
+            counts[key] = counts.get(key, 0) + 1
+        with self.lock:
+            self.stats_dict["batches"] += 1
+            done = [job.path for job in batch if self.latest.get(job.path) == job.seq]
+            for path in done:
+                del self.latest[path]
+        for key, n in counts.items():
+            self._finish(n, key)
+        for path in done:
+            self.scheduler.indexed(path)
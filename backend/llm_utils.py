@@ -1,15 +1,61 @@
-from openai import OpenAI
+import time
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+from openai import OpenAI, AsyncOpenAI
 from langchain.text_splitter import MarkdownHeaderTextSplitter
-import tiktoken
 
+from embedding_cache import embedding_cache
+from token_counter import count_tokens
 from settings import *
 
 client_embed = OpenAI(base_url = EMBEDDING_BASE_URL, api_key = EMBEDDING_API_KEY)
+http_embed = httpx.Client(timeout=600) # for EMBEDDING_ENCODING = "binary", which the openai client can't parse
 client = OpenAI(base_url = CHAT_BASE_URL, api_key = CHAT_API_KEY)
+async_client = AsyncOpenAI(base_url = CHAT_BASE_URL, api_key = CHAT_API_KEY) # used by the chat server so streams don't block the event loop
+
+# Summaries of all digests share these, so the LLM server never gets more than DIGEST_MAX_CONCURRENCY requests from us
+digest_semaphore = threading.BoundedSemaphore(DIGEST_MAX_CONCURRENCY)
+digest_executor = ThreadPoolExecutor(max_workers=DIGEST_MAX_CONCURRENCY, thread_name_prefix="digest")
+
+def decode_embedding(embedding):
+    if isinstance(embedding, str): # base64 of little-endian float32
+        return np.frombuffer(base64.b64decode(embedding), dtype='<f4')
+    return np.asarray(embedding, dtype=np.float32)
 
+# Embed the texts with one request, as float32 vectors that are never turned into lists of floats on the way.
+# Servers that don't support the encoding answer with JSON floats, which are decoded the same.
+def request_embeddings(texts):
+    if EMBEDDING_ENCODING == "binary":
+        response = http_embed.post(f"{EMBEDDING_BASE_URL.rstrip('/')}/embeddings",
+                                   json={"input": texts, "model": EMBEDDING_MODEL_NAME},
+                                   headers={"Authorization": f"Bearer {EMBEDDING_API_KEY}", "Accept": "application/octet-stream"})
+        response.raise_for_status()
+        if response.headers.get("content-type", "").startswith("application/octet-stream"):
+            shape = tuple(int(n) for n in response.headers["X-Embedding-Shape"].split(','))
+            return list(np.frombuffer(response.content, dtype='<f4').reshape(shape))
+        return [decode_embedding(d["embedding"]) for d in response.json()["data"]]
+    data = client_embed.embeddings.create(input=texts, model=EMBEDDING_MODEL_NAME, encoding_format=EMBEDDING_ENCODING).data
+    return [decode_embedding(d.embedding) for d in data]
+
+# Embeddings of the chunks as float32 arrays, from the cache or else the embedding server
+def get_embedding_vectors(chunks):
+    if isinstance(chunks, str):
+        chunks = [chunks]
+    vectors = embedding_cache.get_many(chunks)
+    missing = list(dict.fromkeys(chunk for chunk, vector in zip(chunks, vectors) if vector is None))
+    if missing:
+        new_vectors = dict(zip(missing, embedding_cache.put_many(missing, request_embeddings(missing))))
+        vectors = [new_vectors[chunk] if vector is None else vector for chunk, vector in zip(chunks, vectors)]
+        print(f"embedded {len(missing)} new texts, cache hit rate {embedding_cache.stats()['hit_rate']:.0%}")
+    return vectors
+
+# Embeddings as lists, as Chroma takes them
 def get_embeddings(chunks):
-    data = client_embed.embeddings.create(input=chunks, model=EMBEDDING_MODEL_NAME).data
-    return [d.embedding for d in data]
+    return [vector.tolist() for vector in get_embedding_vectors(chunks)]
 
 def chat(messages:list[dict]):
     response = client.chat.completions.create(
@@ -19,6 +65,17 @@ def chat(messages:list[dict]):
     )
     return response.choices[0].message.content
 
+def summarize(messages:list[dict]):
+    for attempt in range(DIGEST_MAX_RETRIES + 1):
+        try:
+            with digest_semaphore:
+                return chat(messages)
+        except Exception as e:
+            if attempt == DIGEST_MAX_RETRIES:
+                raise
+            print(f"summary failed ({e}), retrying")
+            time.sleep(2 ** attempt)
+
 def simplify_markdown_headers(page_content, current_nesting_level):
     # Split the content into lines for processing
     lines = page_content.split('\n')
@@ -51,16 +108,22 @@ def simplify_markdown_headers(page_content, current_nesting_level):
 
 # This function will try to digest a markdown file into multiple docs based on headers
 def digest_markdown(title, path):
+    with open(path, encoding='utf-8') as f:
+        return digest_markdown_text(title, f.read())
+
+def digest_markdown_text(title, s):
+    return digest_sections(split_markdown(title, s))
+
+# Split a note into (headers, content) sections, the content is what digest_sections summarizes
+def split_markdown(title, s):
     headers = [
         ("#", "header1"),
         ("##", "header2"),
         ("###", "header3"),
     ]
     parent_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers)
-    with open(path, encoding='utf-8') as f:
-        s = f.read()
-        docs = parent_splitter.split_text(s)
-    digests = []
+    docs = parent_splitter.split_text(s)
+    sections = []
     for doc in docs:
         headers = ""
         headers += title
@@ -76,34 +139,39 @@ def digest_markdown(title, path):
             level = 3
         page_content = simplify_markdown_headers(doc.page_content.strip(), level)
         content = f"---Begin Note---\nHeaders: {headers}\n{page_content}\n---End Note---"
-        prompt = SUMMARY_NOTE_PROMPT.replace("{NICK_NAME}", NICK_NAME)
-        prompt = prompt.replace("{LANGUAGE_PREFERENCE}", "" if LANGUAGE_PREFERENCE=="English" else f" The note should be in {LANGUAGE_PREFERENCE}.")
-        summary = chat([
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": content}]
-        )
-        # digest = f"# {headers}\n{summary}"
-        digests.append((headers, summary))
+        sections.append((headers, content))
+    return sections
+
+def digest_sections(sections):
+    prompt = SUMMARY_NOTE_PROMPT.replace("{NICK_NAME}", NICK_NAME)
+    prompt = prompt.replace("{LANGUAGE_PREFERENCE}", "" if LANGUAGE_PREFERENCE=="English" else f" The note should be in {LANGUAGE_PREFERENCE}.")
+    # summarize the sections at the same time, the digests stay in the order of the sections
+    futures = [(headers, digest_executor.submit(summarize, [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": content}]
+    )) for headers, content in sections]
+    # digest = f"# {headers}\n{summary}"
+    digests = [(headers, future.result()) for headers, future in futures]
     return digests
 
 def digest_simple(title, path):
     with open(path, encoding='utf-8') as f:
-        s = f.read()
-        tag = ""
-        if s.startswith('#'): # tagged doc
-            tag, s = s.split('\n',1)
-            tag = tag.lstrip('#').strip()
-        text = f"---{title}---\n{s}"
-        prompt = SUMMARY_PROMPT.replace("{NICK_NAME}", NICK_NAME)
-        prompt = prompt.replace("{LANGUAGE_PREFERENCE}", "" if LANGUAGE_PREFERENCE=="English" else f" The note should be in {LANGUAGE_PREFERENCE}.")
-        summary = chat([
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": text}]).strip()
-        return summary, tag
+        return digest_simple_text(title, f.read())
+
+def digest_simple_text(title, s):
+    tag = ""
+    if s.startswith('#'): # tagged doc
+        tag, s = s.split('\n',1)
+        tag = tag.lstrip('#').strip()
+    text = f"---{title}---\n{s}"
+    prompt = SUMMARY_PROMPT.replace("{NICK_NAME}", NICK_NAME)
+    prompt = prompt.replace("{LANGUAGE_PREFERENCE}", "" if LANGUAGE_PREFERENCE=="English" else f" The note should be in {LANGUAGE_PREFERENCE}.")
+    summary = summarize([
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": text}]).strip()
+    return summary, tag
     
 def count_token(input_str):
-    encoding = tiktoken.get_encoding("o200k_base") # This is only approximation
     if type(input_str) == dict:
         input_str = f"role: {input_str['role']}, content: {input_str['content']}"
-    length = len(encoding.encode(input_str))
-    return length
+    return count_tokens(input_str)
@@ -1,6 +1,8 @@
+import asyncio
 import json
 import re
-from typing import List, Optional, Literal, Union, Iterator, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Literal, Union, AsyncIterator, Dict
 import datetime
 import os
 from enum import Enum
@@ -13,8 +15,12 @@ from pydantic import BaseModel, Field
 from sse_starlette.sse import EventSourceResponse
 
 import llama_types as llama_cpp
-from llm_utils import client
-from retrivial_ranking import search_context, search_context_with_time
+from llm_utils import async_client
+from retrivial_ranking import search_context, fetch_queries, rank_contexts, search_cache, corpus_version
+from session_store import session_store
+from scheduler import indexing_scheduler
+from embedding_cache import embedding_cache
+from chroma_doc_manager import doc_manager
 from settings import *
 
 app = FastAPI(
@@ -30,9 +36,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-server_state = {"last_use":None}
-latest_chat_time = None
-latest_chat_message = None
+# Retrieval (Chroma, BM25, digest files) is blocking, so it runs on a bounded pool off the event loop
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_WORKERS, thread_name_prefix="search")
+
+# reported by /v1/metrics together with the indexing metrics
+indexing_scheduler.register("embedding_cache", embedding_cache.stats)
+indexing_scheduler.register("document_cache", doc_manager.cache.stats)
+indexing_scheduler.register("search_cache", search_cache.stats)
+indexing_scheduler.register("sessions", lambda: {"sessions": len(session_store)})
 
 MAX_NUM_QUERY = 3
 
@@ -146,9 +157,24 @@ async def get_api_key(api_key_header: str = Depends(api_key_header)):
             status_code=403, 
             detail="Could not validate API Key"
         )
+
+def build_prompt_messages(chat_time):
+    prompt = AGENT_PROMPT.replace("{CURRENT_TIME}", chat_time).replace("{NICK_NAME}", NICK_NAME)
+    prompt = prompt.replace("{LANGUAGE_PREFERENCE}", "" if LANGUAGE_PREFERENCE=="English" else f"\n**Your default langauge for search queries and reply contents is {LANGUAGE_PREFERENCE}.**")
+    print(">>>", LANGUAGE_PREFERENCE, prompt)
+    prompt_messages = [{'role':'system', 'content': prompt}]
     
-# TODO find other solutions
-response_start = False
+    language = LANGUAGE_PREFERENCE
+    # add one-shot prompt
+    prompt_messages += [
+        {'role':'user','content': lang_presets["languages"][language]["user_message"]},
+        {'role':'assistant','content':f'<THINK>{lang_presets["languages"][language]["think_message"].format(NICK_NAME=NICK_NAME)}</THINK>'},
+        {'role':'assistant','content':f'<SEARCH>\n{lang_presets["languages"][language]["search_query"].format(NICK_NAME=NICK_NAME)}</SEARCH>'},
+        generate_system_message(f'---begin search result---\n<context_1 title="{lang_presets["languages"][language]["context_title"]}">\n{lang_presets["languages"][language]["context_content"].format(NICK_NAME=NICK_NAME)}\n---end search result---'),
+        {'role':'assistant','content':f'<REPLY>{lang_presets["languages"][language]["reply_message"].format(NICK_NAME=NICK_NAME)}</REPLY>'},
+    ]
+    return prompt_messages
+
 @app.post(
     "/v1/chat/completions",
     response_model=llama_cpp.ChatCompletion,
@@ -156,6 +182,14 @@ response_start = False
 async def create_chat_completion(
         request: CreateChatCompletionRequest, user: str = Depends(get_api_key)
 ) -> Union[llama_cpp.ChatCompletion, EventSourceResponse]:
+    with indexing_scheduler.interactive(): # background indexing yields to chat requests
+        return await chat_completion(request, user)
+
+@app.get("/v1/metrics")
+async def get_metrics(user: str = Depends(get_api_key)):
+    return indexing_scheduler.metrics()
+
+async def chat_completion(request: CreateChatCompletionRequest, user: str):
     print(f"call from {user}")
     kwargs = request.dict(exclude={"model", "n", "presence_penalty", "frequency_penalty", "logit_bias", "user", })
     # print("debug: ", json.dumps(kwargs).encode('utf-8').decode('unicode_escape'))
@@ -165,19 +199,15 @@ async def create_chat_completion(
     print('### USER: ', last_chat)
 
 
-    # A simple solution: judge if the conversation is new by comparing the first user message
-    global latest_chat_message,latest_chat_time, server_state
+    # Judge if the conversation is new by the user and the first user message
     time_now = datetime.datetime.now()
-    server_state["last_use"] = time_now
-    if latest_chat_message and messages[1]['content'] == latest_chat_message:
+    session, continued = session_store.get_or_create(user, messages, time_now.strftime('%Y-%m-%d %H:%M:%S'))
+    if continued:
         print("Continued conversation")
-    else:
-        latest_chat_message = messages[1]['content']
-        latest_chat_time = time_now.strftime('%Y-%m-%d %H:%M:%S')
     
     if '*SAVE*' in last_chat:
         try:
-            title = 'Conversation on ' + latest_chat_time
+            title = 'Conversation on ' + session.chat_time
             filename = title.replace(':',';') + '.md'
             tag = last_chat.lstrip().replace("*SAVE*", "", 1).strip()
             formatted_conversation = ""
@@ -204,21 +234,10 @@ async def create_chat_completion(
     state = OutputState.Input
     all_context_list = []
 
-    prompt = AGENT_PROMPT.replace("{CURRENT_TIME}", latest_chat_time).replace("{NICK_NAME}", NICK_NAME)
-    prompt = prompt.replace("{LANGUAGE_PREFERENCE}", "" if LANGUAGE_PREFERENCE=="English" else f"\n**Your default langauge for search queries and reply contents is {LANGUAGE_PREFERENCE}.**")
-    print(">>>", LANGUAGE_PREFERENCE, prompt)
+    if session.prompt_messages is None:
+        session.prompt_messages = build_prompt_messages(session.chat_time)
     # Prepare formmating
-    new_messages = [{'role':'system', 'content': prompt}]
-    
-    language = LANGUAGE_PREFERENCE
-    # add one-shot prompt
-    new_messages += [
-        {'role':'user','content': lang_presets["languages"][language]["user_message"]},
-        {'role':'assistant','content':f'<THINK>{lang_presets["languages"][language]["think_message"].format(NICK_NAME=NICK_NAME)}</THINK>'},
-        {'role':'assistant','content':f'<SEARCH>\n{lang_presets["languages"][language]["search_query"].format(NICK_NAME=NICK_NAME)}</SEARCH>'},
-        generate_system_message(f'---begin search result---\n<context_1 title="{lang_presets["languages"][language]["context_title"]}">\n{lang_presets["languages"][language]["context_content"].format(NICK_NAME=NICK_NAME)}\n---end search result---'),
-        {'role':'assistant','content':f'<REPLY>{lang_presets["languages"][language]["reply_message"].format(NICK_NAME=NICK_NAME)}</REPLY>'},
-    ]
+    new_messages = [message.copy() for message in session.prompt_messages]
     
     for i in range(1, len(messages)):
         if messages[i]['role'] == 'assistant':
@@ -249,22 +268,23 @@ async def create_chat_completion(
         else:
             return ""
         
-    def stream_output(
-            chat_chunks: Iterator[llama_cpp.ChatCompletionChunk], extra_text: str
+    async def stream_output(
+            chat_chunks: AsyncIterator[llama_cpp.ChatCompletionChunk], extra_text: str
     ):
         nonlocal state, all_context_list
-        for chat_chunk in chat_chunks:
-            if state == OutputState.ToReply:
-                state = OutputState.Reply
-                print('### ASSISTANT: ', end='')
-                if extra_text:
-                    chat_chunk.choices[0].delta.content = extra_text + chat_chunk.choices[0].delta.content
-            s = chat_chunk.choices[0].delta.content
-            if not s:
-                chat_chunk.choices[0].delta.content = "" # avoid output null when stop
-            chat_chunk.choices[0].finish_reason = None # avoid "stop" causing ref_text not received
-            print(s,end='')
-            yield dict(data=json.dumps(serialize_chat_chunk(chat_chunk)))
+        with indexing_scheduler.interactive(): # the reply is still streamed after the request handler returned
+            async for chat_chunk in chat_chunks:
+                if state == OutputState.ToReply:
+                    state = OutputState.Reply
+                    print('### ASSISTANT: ', end='')
+                    if extra_text:
+                        chat_chunk.choices[0].delta.content = extra_text + chat_chunk.choices[0].delta.content
+                s = chat_chunk.choices[0].delta.content
+                if not s:
+                    chat_chunk.choices[0].delta.content = "" # avoid output null when stop
+                chat_chunk.choices[0].finish_reason = None # avoid "stop" causing ref_text not received
+                print(s,end='')
+                yield dict(data=json.dumps(serialize_chat_chunk(chat_chunk)))
         print('\n')
 
         if state == OutputState.Reply:
@@ -290,7 +310,7 @@ async def create_chat_completion(
 
             if state==OutputState.Input:
                 chain_length += 1
-                completion_or_chunks = client.chat.completions.create(
+                completion_or_chunks = await async_client.chat.completions.create(
                     model=CHAT_MODEL_NAME,
                     messages=new_messages,
                     temperature=0.1,
@@ -301,11 +321,23 @@ async def create_chat_completion(
 
         
             accumulated_content = ''
+            fetches = {} # query -> (future of the retrieval it was started with, its index there)
+            loop = asyncio.get_running_loop()
+
+            def start_fetches(search_text, speculative=True):
+                version = corpus_version()
+                # a query of a cached search is likely part of a repeated one, which needs no retrieval
+                new_queries = [query_str for query_str in dict.fromkeys(arrange_query_string(search_text.strip()))
+                               if query_str not in fetches and not (speculative and search_cache.contains(query_str, version))]
+                if new_queries: # the lines finished together are retrieved in one batch
+                    future = loop.run_in_executor(search_executor, fetch_queries, new_queries)
+                    for i, query_str in enumerate(new_queries):
+                        fetches[query_str] = (future, i)
             
-            def get_stream(chat_chunks:Iterator[llama_cpp.ChatCompletionChunk]):
+            async def get_stream(chat_chunks:AsyncIterator[llama_cpp.ChatCompletionChunk]):
                 nonlocal accumulated_content
                 output_state = OutputState.Input
-                for chat_chunk in chat_chunks:
+                async for chat_chunk in chat_chunks:
                     if chat_chunk.choices[0].finish_reason:
                         break;
                     s = chat_chunk.choices[0].delta.content
@@ -317,11 +349,15 @@ async def create_chat_completion(
                         elif '<REPLY>' in accumulated_content:
                             output_state = OutputState.ToReply
                             return output_state
+                    if output_state == OutputState.Search and '\n' in s:
+                        # retrieve the complete lines while the model writes the next ones
+                        search_text = accumulated_content.split('<SEARCH>', 1)[-1]
+                        start_fetches(search_text[:search_text.rfind('\n')])
                 if output_state ==  OutputState.Search:
                     return OutputState.ToSearch
                 return output_state
             
-            state = get_stream(completion_or_chunks)
+            state = await get_stream(completion_or_chunks)
             monologue = extract_tagged_content(accumulated_content, 'THINK').strip()
             if len(monologue):
                 new_messages.append({"role":"assistant", "content": f"<THINK>{monologue}</THINK>"})
@@ -332,7 +368,16 @@ async def create_chat_completion(
                     queries = arrange_query_string(search_string)
                     print("queries:", queries)
                     new_messages.append({"role":"assistant", "content": f"<SEARCH>{search_string}</SEARCH>"})
-                    context_list = search_context_with_time(queries)
+                    version = corpus_version()
+                    context_list = await loop.run_in_executor(search_executor, search_cache.get, queries, version)
+                    if context_list is None:
+                        start_fetches(search_string, speculative=False) # the last line, or all of them if the block came at once
+                        await asyncio.gather(*{fetches[query_str][0] for query_str in queries})
+                        fetched = [future.result()[i] for future, i in (fetches[query_str] for query_str in queries)]
+                        context_list = await loop.run_in_executor(search_executor, rank_contexts, queries, fetched)
+                        await loop.run_in_executor(search_executor, search_cache.put, queries, version, context_list)
+                    else:
+                        print("Reuse cached search result")
                     if context_list:
                         search_result = '<br/>\n'.join([format_context(i, ctx) for i, ctx in enumerate(context_list)])
                         all_context_list += [ctx.doc_id for ctx in context_list]
@@ -342,7 +387,7 @@ async def create_chat_completion(
                     state = OutputState.Input
 
             elif state == OutputState.ToReply:
-                chunks: Iterator[llama_cpp.ChatCompletionChunk] = completion_or_chunks  # type: ignore
+                chunks: AsyncIterator[llama_cpp.ChatCompletionChunk] = completion_or_chunks  # type: ignore
                 extra_text = accumulated_content.split('<REPLY>',1)[-1]
                 return EventSourceResponse(
                     stream_output(chunks, extra_text),
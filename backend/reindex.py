@@ -0,0 +1,194 @@
+# Rebuild the Chroma and BM25 indexes from the digests, to recover from a broken digests/chroma or
+# after changing EMBEDDING_MODEL_NAME, without digesting anything again. Run it while the server
+# is stopped:
+#   python reindex.py --batch-size 256 --concurrency 4
+# Every digest is read once, split into chunks the way ChromaDocManager does, embedded in large
+# batches with several requests in flight and upserted into a new database folder, which replaces
+# the one in use only once it is complete. The BM25 index is built from the same pass, the tokens
+# of every digest are handed to it as they are made instead of being kept until the end.
+import os
+import time
+import queue
+import shutil
+import argparse
+import datetime
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import chromadb
+from chromadb.config import Settings
+
+from bm25_api import BM25Index, INDEX_FOLDER, is_digest_file, load_digest, digest_stamp, preprocess, saved_generation
+from chroma_index import ROOT_FOLDER, prepare_index, active_chroma_path, set_active_chroma
+from digest_manifest import DigestManifest
+from llm_utils import get_embedding_vectors
+
+METADATA_PAGE = 5000
+
+# Metadata of the digests in the database in use by doc_id, empty if it can't be read
+def read_metadata(path):
+    try:
+        client = chromadb.PersistentClient(path=path, settings=Settings(anonymized_telemetry=False))
+        collection = client.get_collection(name='digests', embedding_function=None)
+        metadatas = {}
+        offset = 0
+        while True:
+            res = collection.get(include=["metadatas"], limit=METADATA_PAGE, offset=offset)
+            for metadata in res["metadatas"]:
+                metadatas.setdefault(metadata["doc_id"], metadata)
+            if len(res["ids"]) < METADATA_PAGE:
+                return metadatas
+            offset += METADATA_PAGE
+    except Exception as e:
+        print(f"can't read the metadata in {path} ({e}), deriving it from the digests")
+        return {}
+
+# Note title by doc_id of its sections, from the digest manifest
+def read_note_names():
+    note_names = {}
+    for path, entry in DigestManifest().files.items():
+        title = os.path.basename(path).rsplit(".", 1)[0].replace(';', ':')
+        for doc_id in entry["sections"]:
+            note_names[doc_id] = title
+    return note_names
+
+# The metadata ingestion gives a digest, for digests the database in use doesn't know
+def derive_metadata(doc_id, file, note_names):
+    if doc_id.startswith("Conversation"):
+        return {"doc_time": doc_id.rsplit("on", 1)[1][1:11]}
+    # notes are dated when they are digested, which is when the digest file was written
+    mtime = os.path.getmtime(os.path.join(ROOT_FOLDER, file))
+    metadata = {"doc_time": datetime.date.fromtimestamp(mtime).strftime("%Y-%m-%d")}
+    if doc_id in note_names:
+        metadata["doc_name"] = note_names[doc_id]
+    return metadata
+
+class Progress():
+    def __init__(self, n_files, interval):
+        self.n_files = n_files
+        self.interval = interval
+        self.start = self.last = time.perf_counter()
+        self.files = 0
+        self.chunks = 0
+        self.seconds = {"read": 0., "embed": 0., "upsert": 0., "bm25": 0.}
+
+    def report(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        eta = elapsed / self.files * (self.n_files - self.files) if self.files else 0
+        print(f"{self.files}/{self.n_files} digests, {self.chunks} chunks upserted, "
+              f"{self.files / elapsed:.1f} digests/s, {self.chunks / elapsed:.1f} chunks/s, ETA {eta:.0f}s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the Chroma and BM25 indexes from the digests")
+    parser.add_argument("--batch-size", type=int, default=256, help="chunks per embedding request")
+    parser.add_argument("--concurrency", type=int, default=4, help="embedding requests in flight")
+    parser.add_argument("--upsert-size", type=int, default=5000, help="chunks per upsert")
+    parser.add_argument("--progress", type=float, default=5, help="seconds between progress reports")
+    parser.add_argument("--derive-metadata", action="store_true", help="don't read the metadata from the database in use")
+    parser.add_argument("--keep-old", action="store_true", help="keep the folder of the replaced database")
+    args = parser.parse_args()
+
+    old_path = active_chroma_path()
+    files = sorted(file for file in os.listdir(ROOT_FOLDER) if is_digest_file(file))
+    known = {} if args.derive_metadata else read_metadata(old_path)
+    note_names = read_note_names()
+    print(f"reindexing {len(files)} digests, metadata of {len(known)} from {old_path}")
+
+    name = "chroma_" + datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    client = chromadb.PersistentClient(path=os.path.join(ROOT_FOLDER, name), settings=Settings(anonymized_telemetry=False))
+    collection = client.get_or_create_collection(name='digests', embedding_function=None)
+    upsert_size = min(args.upsert_size, client.max_batch_size)
+    progress = Progress(len(files), args.progress)
+    executor = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="reindex")
+    in_flight = deque() # futures of embedded batches, upserted in order
+    # BM25Index.load takes the tokens of the digests on its own thread while they are read, a daemon
+    # thread so a reindex that fails exits without saving a partial index
+    bm25_queue = queue.Queue(maxsize=1024)
+    bm25_done = Future()
+    def build_bm25():
+        try:
+            index = BM25Index(path=INDEX_FOLDER)
+            index.generation = saved_generation(INDEX_FOLDER)
+            index.load(iter(bm25_queue.get, None))
+            bm25_done.set_result(len(index))
+        except Exception as e:
+            bm25_done.set_exception(e)
+    threading.Thread(target=build_bm25, name="reindex-bm25", daemon=True).start()
+
+    def to_bm25(item):
+        while not bm25_done.done():
+            try:
+                bm25_queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        bm25_done.result() # raises what stopped the build
+
+    def embed(ids, chunks, metadatas, n_files):
+        start = time.perf_counter()
+        vectors = get_embedding_vectors(chunks)
+        return ids, chunks, metadatas, vectors, n_files, time.perf_counter() - start
+
+    def upsert(future):
+        ids, chunks, metadatas, vectors, n_files, seconds = future.result()
+        progress.seconds["embed"] += seconds
+        start = time.perf_counter()
+        for i in range(0, len(ids), upsert_size):
+            collection.upsert(ids=ids[i:i+upsert_size], documents=chunks[i:i+upsert_size], metadatas=metadatas[i:i+upsert_size],
+                              embeddings=[vector.tolist() for vector in vectors[i:i+upsert_size]])
+        progress.seconds["upsert"] += time.perf_counter() - start
+        progress.files += n_files
+        progress.chunks += len(ids)
+        progress.report()
+
+    batch = ([], [], []) # ids, chunks, metadatas
+    batch_files = 0
+    for file in files:
+        start = time.perf_counter()
+        doc_id = file.replace(';', ':') # revert conversion for Windows file name rules
+        document = load_digest(file)
+        other_meta = {key: value for key, value in known[doc_id].items() if key not in ("doc_id", "n_tokens")} \
+            if doc_id in known else derive_metadata(doc_id, file, note_names)
+        for values, new_values in zip(batch, prepare_index(document, doc_id, other_meta)):
+            values.extend(new_values)
+        batch_files += 1
+        to_bm25((doc_id, preprocess(document), digest_stamp(file, document)))
+        progress.seconds["read"] += time.perf_counter() - start
+        if len(batch[0]) >= args.batch_size:
+            in_flight.append(executor.submit(embed, *batch, batch_files))
+            batch, batch_files = ([], [], []), 0
+            while len(in_flight) > args.concurrency:
+                upsert(in_flight.popleft())
+    in_flight.append(executor.submit(embed, *batch, batch_files))
+    while in_flight:
+        upsert(in_flight.popleft())
+    progress.report(force=True)
+
+    # the BM25 index only depends on the digests, it is saved even if the new database is not used
+    start = time.perf_counter()
+    to_bm25(None)
+    bm25_done.result()
+    progress.seconds["bm25"] = time.perf_counter() - start
+
+    n_chunks = collection.count()
+    if n_chunks != progress.chunks:
+        raise SystemExit(f"the new database has {n_chunks} chunks instead of {progress.chunks}, keeping {old_path}")
+
+    set_active_chroma(name)
+    print(f"switched to {os.path.join(ROOT_FOLDER, name)}")
+    if not args.keep_old and os.path.abspath(old_path) != os.path.abspath(os.path.join(ROOT_FOLDER, name)):
+        shutil.rmtree(old_path, ignore_errors=True)
+        print(f"removed {old_path}")
+
+    elapsed = time.perf_counter() - progress.start
+    print(f"done in {elapsed:.1f}s: {len(files)} digests, {n_chunks} chunks, {n_chunks / elapsed:.1f} chunks/s")
+    print("seconds spent: " + ", ".join(f"{stage} {seconds:.1f}" for stage, seconds in progress.seconds.items()) +
+          " (embed is summed over the requests in flight, bm25 is the wait for the index after the last upsert)")
+
+if __name__ == "__main__":
+    main()
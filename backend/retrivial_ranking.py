@@ -1,32 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from math import sqrt
-from dateparser import parse
-from dateparser.search import search_dates
+
+import numpy as np
 
 from chroma_doc_manager import doc_manager
-from llm_utils import count_token
-from bm25_api import get_norm_bm25_scores, get_avg_bm25_scores
+from date_extraction import language_dict, search_query_dates, parse_date
+from llm_utils import count_token, get_embedding_vectors
+from token_counter import count_tokens_batch
+from search_cache import SearchCache
+from bm25_api import get_avg_bm25_scores, get_top_bm25_scores, standardize
 from settings import *
 
-# Dictionary containing language codes and keywords for each supported language
-language_dict = {
-    'English': {'code': 'en', 'month': 'month', 'week': 'week'},
-    'Chinese': {'code': 'zh', 'month': '月', 'week': '周'},
-    'German': {'code': 'de', 'month': 'monat', 'week': 'woche'},
-    'French': {'code': 'fr', 'month': 'mois', 'week': 'semaine'},
-    'Spanish': {'code': 'es', 'month': 'mes', 'week': 'semana'},
-    'Portuguese': {'code': 'pt', 'month': 'mês', 'week': 'semana'},
-    'Italian': {'code': 'it', 'month': 'mese', 'week': 'settimana'},
-    'Dutch': {'code': 'nl', 'month': 'maand', 'week': 'week'},
-    'Czech': {'code': 'cs', 'month': 'měsíc', 'week': 'týden'},
-    'Polish': {'code': 'pl', 'month': 'miesiąc', 'week': 'tydzień'},
-    'Russian': {'code': 'ru', 'month': 'месяц', 'week': 'неделя'},
-    'Arabic': {'code': 'ar', 'month': 'شهر', 'week': 'أسبوع'}
-}
-
-
 class ConversationContext():
-    def __init__(self, doc_id, doc_content, score, doc_time=None, match_str=None):
+    __slots__ = ("doc_id", "content", "full", "tokens", "value", "doc_time")
+
+    def __init__(self, doc_id, doc_content, score, doc_time=None, match_str=None, tokens=None):
         self.doc_id = doc_id
         if match_str:
             segments = self.split_dialogue(doc_content)
@@ -37,12 +26,45 @@ class ConversationContext():
             self.content = doc_content
             self.full = True
 
-        self.tokens = count_token(self.content)
+        self.tokens = tokens if tokens is not None and self.full else count_token(self.content) # tokens of the full document if known
         self.value = score/(1+self.tokens/150)
         self.doc_time = doc_time
 
     def __repr__(self):
-        return str(self.__dict__)
+        return str({name: getattr(self, name) for name in self.__slots__})
+
+# Candidates of a search as columns: one row per search result, or per document after aggregate()
+class Candidates():
+    __slots__ = ("doc_ids", "doc_times", "scores", "n_tokens")
+
+    def __init__(self, doc_ids, doc_times, scores, n_tokens):
+        self.doc_ids = doc_ids
+        self.doc_times = doc_times
+        self.scores = scores # nan for documents only BM25 found
+        self.n_tokens = n_tokens # nan for documents indexed without a count
+
+    @classmethod
+    def of_metadatas(cls, metadatas, scores):
+        n_tokens = [metadata.get('n_tokens') for metadata in metadatas]
+        return cls([metadata['doc_id'] for metadata in metadatas], [metadata['doc_time'] for metadata in metadatas],
+                   np.asarray(scores, dtype=np.float64), np.array([np.nan if n is None else n for n in n_tokens], dtype=np.float64))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def concat(self, other):
+        return Candidates(self.doc_ids + other.doc_ids, self.doc_times + other.doc_times,
+                          np.concatenate([self.scores, other.scores]), np.concatenate([self.n_tokens, other.n_tokens]))
+
+    # One row per document in the order they were first found, with the sum of its scores
+    def aggregate(self):
+        index = {}
+        rows = np.fromiter((index.setdefault(doc_id, len(index)) for doc_id in self.doc_ids), dtype=np.intp, count=len(self.doc_ids))
+        scores = np.bincount(rows, weights=self.scores, minlength=len(index))
+        n_tokens = np.full(len(index), np.nan)
+        np.fmax.at(n_tokens, rows, self.n_tokens)
+        first = np.unique(rows, return_index=True)[1]
+        return Candidates(list(index), [self.doc_times[i] for i in first], scores, n_tokens)
 
 def aggregate_scores(associations):
     scores_dict = {}
@@ -55,7 +77,7 @@ def aggregate_scores(associations):
 
 def doc_time_dict(associations):
     time_dict = {}
-    for doc_id,doc_time,_ in associations:
+    for doc_id,doc_time,*_ in associations:
         if doc_id not in time_dict:
             time_dict[doc_id] = doc_time
     return time_dict
@@ -64,8 +86,7 @@ def search_context(queries, n_choices = 8):
     query_strings = queries
     query_times = []
     for query_str in queries:
-        language_list = ['en'] if LANGUAGE_PREFERENCE=="English" else [language_dict[LANGUAGE_PREFERENCE]['code'], 'en']
-        dates = search_dates(query_str, languages=language_list, settings={"PREFER_DATES_FROM":"past"})
+        dates = search_query_dates(query_str)
         date = None
         if dates:
             date_str, date = dates[-1]
@@ -125,20 +146,16 @@ def search_context(queries, n_choices = 8):
     return ctx_list
 
 def parse_date_range(start_date_str: str, end_date_str: str):
-    language_info = language_dict[LANGUAGE_PREFERENCE]
-    language_list = ['en'] if LANGUAGE_PREFERENCE == "English" else [language_info['code'], 'en']
-    
-    start_date = parse(start_date_str, languages=language_list, settings={"PREFER_DATES_FROM":"past", "PREFER_MONTH_OF_YEAR": "first", 'PREFER_DAY_OF_MONTH': 'first'})
-    end_date = parse(end_date_str, languages=language_list, settings={"PREFER_DATES_FROM":"past", "PREFER_MONTH_OF_YEAR": "last", 'PREFER_DAY_OF_MONTH': 'last'})
+    start_date = parse_date(start_date_str, "first")
+    end_date = parse_date(end_date_str, "last")
     return start_date, end_date
 
 def generate_time_range(date_str: str):
 
     language_info = language_dict[LANGUAGE_PREFERENCE]
-    language_list = ['en'] if LANGUAGE_PREFERENCE == "English" else [language_info['code'], 'en']
     
-    start_date = parse(date_str, languages=language_list, settings={"PREFER_DATES_FROM":"past", "PREFER_MONTH_OF_YEAR": "first", 'PREFER_DAY_OF_MONTH': 'first'})
-    end_date = parse(date_str, languages=language_list, settings={"PREFER_DATES_FROM":"past", "PREFER_MONTH_OF_YEAR": "last", 'PREFER_DAY_OF_MONTH': 'last'})
+    start_date = parse_date(date_str, "first")
+    end_date = parse_date(date_str, "last")
     
     date_str_lower = date_str.lower()
     
@@ -164,87 +181,184 @@ def cal_score(dist, len_query):
     return (1/(dist+.01)-1)/norm
 
 # adjust for overall false-positive
-def get_adjust_factor(double_associations, n_required):
+def get_adjust_factor(distances, n_required):
     rectify_factor = 0.5
-    spare_asso = double_associations[n_required:]
-    if not spare_asso:
+    n_weight = len(distances) - n_required
+    if n_weight <= 0:
         return 1
-    n_weight = len(spare_asso)
-    # avg = sum([x[2] for x in spare_asso])/n_weight
-    last = double_associations[n_required + n_weight - 1][2]
+    last = distances[-1]
     return (1/last-1)*(rectify_factor*n_weight/n_required) + 1
 
-def get_all_associations(queries, n_choices=RETRIEVAL_NUM_CHOICES):
-    query_strings = queries
-    query_result = doc_manager.query_by_strings(query_strings, n_results=n_choices*2)
-    print(query_result)
-    all_associations = []
-    for i, query_str in enumerate(query_strings):
-        language_list = ['en'] if LANGUAGE_PREFERENCE=="English" else [language_dict[LANGUAGE_PREFERENCE]['code'], 'en']
-        dates = search_dates(query_str, languages=language_list, settings={"PREFER_DATES_FROM":"past"})
-        if dates:
+# Find the date expression of a query and return (query without it, start_date, end_date), or None
+def get_query_time_range(query_str):
+    dates = search_query_dates(query_str)
+    if not dates:
+        return None
+    if len(dates) > 1:
+        start_date_str, _ = dates[-2]
+        end_date_str, _ = dates[-1]
+        start_date, end_date = parse_date_range(start_date_str, end_date_str)
+        start_index = query_str.find(start_date_str)
+        end_index = query_str.find(end_date_str, start_index + len(start_date_str))
+        new_query_str = query_str[:start_index] + query_str[end_index + len(end_date_str):]
+        print("new_query: ", new_query_str)
+    else:
+        date_str, _ = dates[-1]
+        start_date, end_date = generate_time_range(date_str)
+        new_query_str = query_str.replace(date_str, "")
+    return new_query_str, start_date, end_date
+
+# BM25 over the whole corpus runs here while the vector search waits for the embeddings
+bm25_executor = ThreadPoolExecutor(max_workers=SEARCH_MAX_WORKERS, thread_name_prefix="bm25")
+
+# Retrieval is done in two steps, so a search can start on its first queries before the others are known:
+# fetch_queries gets the results of each query on its own, rank_contexts merges the results of all
+# queries of the search and selects the contexts.
+
+# One (query_result, time_range_result, bm25_top) per query: the vector search results, the results of
+# the query without its date limited to the time range (None without a date) and the top BM25 documents.
+# The vector searches of all the queries are embedded in one request.
+def fetch_queries(queries, n_choices=RETRIEVAL_NUM_CHOICES):
+    if HYBRID_FUSION != "none":
+        bm25_futures = [bm25_executor.submit(get_top_bm25_scores, query_str, HYBRID_BM25_CANDIDATES) for query_str in queries]
+    time_ranges = [get_query_time_range(query_str) for query_str in queries]
+    searches = [(query_str, None, None) for query_str in queries]
+    searches += [time_range for time_range in time_ranges if time_range]
+    results = doc_manager.query_batch(searches, n_results=n_choices*2)
+    query_results, time_range_results = results[:len(queries)], iter(results[len(queries):])
+    print(query_results)
+    bm25_tops = [future.result() for future in bm25_futures] if HYBRID_FUSION != "none" else [[] for _ in queries]
+    return [(query_result, next(time_range_results) if time_range else None, bm25_top)
+            for query_result, time_range, bm25_top in zip(query_results, time_ranges, bm25_tops)]
+
+# Score the vector search results of the queries of a search, the scores depend on their number
+def associations_of_fetches(fetches, n_choices=RETRIEVAL_NUM_CHOICES):
+    n_queries = len(fetches)
+    metadatas, scores = [], []
+    for query_result, new_query_result, _ in fetches:
+        distances = np.asarray(query_result['distances'], dtype=np.float64)
+        adj_factor = get_adjust_factor(distances, n_choices)
+        print("adj_factor: ", adj_factor)
+        if new_query_result is not None:
             time_factor = 1.5
-            double_associations = [(metadata['doc_id'], metadata['doc_time'], distance) for metadata, distance in zip(query_result['metadatas'][i], query_result['distances'][i])]
-            adj_factor = get_adjust_factor(double_associations, n_choices)
-            print("adj_factor: ", adj_factor)
-            associations = [(x,y,cal_score(z*adj_factor*time_factor, len(queries))) for x,y,z in double_associations[:n_choices//2]] # first half is still original results with distance penalty
-            
-            if len(dates) > 1:
-                start_date_str, _ = dates[-2]
-                end_date_str, _ = dates[-1]
-                start_date, end_date = parse_date_range(start_date_str, end_date_str)
-                start_index = query_str.find(start_date_str)
-                end_index = query_str.find(end_date_str, start_index + len(start_date_str))
-                new_query_str = query_str[:start_index] + query_str[end_index + len(end_date_str):]
-                print("new_query: ", new_query_str)
-            else:
-                date_str, _ = dates[-1]
-                start_date, end_date = generate_time_range(date_str)
-                new_query_str = query_str.replace(date_str, "")
-                            
-            new_query_result = doc_manager.query_by_strings_with_time_range([new_query_str], n_results=n_choices*2, start_time=start_date, end_time=end_date)
-            new_double_associations = [(metadata['doc_id'], metadata['doc_time'], distance) for metadata, distance in zip(new_query_result['metadatas'][0], new_query_result['distances'][0])]
-            new_adj_factor = get_adjust_factor(new_double_associations, n_choices)
+            # first half is still original results with distance penalty
+            metadatas += query_result['metadatas'][:n_choices//2]
+            scores.append(cal_score(distances[:n_choices//2]*adj_factor*time_factor, n_queries))
+
+            new_distances = np.asarray(new_query_result['distances'], dtype=np.float64)
+            new_adj_factor = get_adjust_factor(new_distances, n_choices)
             print("new_adj_factor: ", new_adj_factor)
-            new_associations = [(x,y,cal_score(z*adj_factor/time_factor, len(queries))) for x,y,z in new_double_associations[:n_choices//2]]
-            associations += new_associations
+            metadatas += new_query_result['metadatas'][:n_choices//2]
+            scores.append(cal_score(new_distances[:n_choices//2]*adj_factor/time_factor, n_queries))
         else:
-            double_associations = [(metadata['doc_id'], metadata['doc_time'], distance) for metadata, distance in zip(query_result['metadatas'][i], query_result['distances'][i])]
-            adj_factor = get_adjust_factor(double_associations, n_choices)
-            print("adj_factor: ", adj_factor)
-            associations = [(x,y,cal_score(z*adj_factor, len(queries))) for x,y,z in double_associations[:n_choices]]
-        all_associations += associations
+            metadatas += query_result['metadatas'][:n_choices]
+            scores.append(cal_score(distances[:n_choices]*adj_factor, n_queries))
 
-    # print(all_associations)
-    return all_associations
+    return Candidates.of_metadatas(metadatas, np.concatenate(scores) if scores else [])
 
-def search_context_with_time(queries):
-    all_associations = get_all_associations(queries)
-    score_dict = aggregate_scores(all_associations)
-    time_dict = doc_time_dict(all_associations)
-    
-    agg_list = sorted(list(score_dict.items()), key=lambda x: x[1], reverse=True) # (doc_id, score)
+# Combine the scores of the candidates in one pass. vector_scores is nan for the documents only BM25 found.
+# The result is on the scale of the vector scores, so the thresholds of the selection keep their meaning:
+#   zscore: weighted sum of the standardized scores, mapped back onto the mean and spread of the vector scores
+#   rrf: weighted reciprocal rank fusion, scaled to the best vector score
+#   none: vector scores plus the BM25 score as a small bonus
+def fuse_scores(vector_scores, bm25_scores, method=HYBRID_FUSION, weight=HYBRID_BM25_WEIGHT):
+    vector_scores = np.asarray(vector_scores, dtype=np.float64)
+    bm25_scores = np.asarray(bm25_scores, dtype=np.float64)
+    found = ~np.isnan(vector_scores)
+    if not found.any():
+        return bm25_scores
+    # not found by the vector search means no better than the worst it found
+    vector_scores = np.where(found, vector_scores, vector_scores[found].min())
+    if method == "rrf":
+        vector_ranks = np.argsort(np.argsort(-vector_scores, kind='stable'), kind='stable')
+        bm25_ranks = np.argsort(np.argsort(-bm25_scores, kind='stable'), kind='stable')
+        fused = (1 - weight) / (HYBRID_RRF_K + vector_ranks) + weight / (HYBRID_RRF_K + bm25_ranks)
+        return fused / fused.max() * vector_scores.max()
+    if method == "zscore":
+        fused = (1 - weight) * standardize(vector_scores) + weight * standardize(bm25_scores)
+        return vector_scores.mean() + vector_scores.std() * fused
+    return vector_scores + bm25_scores * BM25_WEIGHT
+
+def resolved_time_range(query_str):
+    time_range = get_query_time_range(query_str)
+    return time_range and (time_range[1].strftime("%Y-%m-%d"), time_range[2].strftime("%Y-%m-%d"))
+
+# Ranked results of recent searches. Queries can be relative to today ("yesterday"), so a result
+# is valid until the digests change or the day does.
+search_cache = SearchCache(get_embedding_vectors if SEARCH_CACHE_SIMILARITY < 1 else None, resolved_time_range, SEARCH_CACHE_SIZE, SEARCH_CACHE_SIMILARITY)
+
+def corpus_version():
+    return doc_manager.version, datetime.now().strftime("%Y-%m-%d")
+
+# Indexes of the candidates taken by the greedy selection
+#   for each candidate in order: if limit > tokens: take it, limit -= tokens
+# The candidates before the first one that doesn't fit are found with one cumulative sum, the
+# loop only goes over the rest and stops once the smallest of them doesn't fit either.
+def budgeted_selection(tokens, limit):
+    used = np.cumsum(tokens)
+    n_prefix = int(np.searchsorted(used, limit, side='left'))
+    selected = list(range(n_prefix))
+    remaining = limit - (used[n_prefix-1] if n_prefix else 0)
+    rest_min = np.minimum.accumulate(tokens[::-1])[::-1]
+    for i in range(n_prefix + 1, len(tokens)):
+        if remaining <= rest_min[i]:
+            break
+        if remaining > tokens[i]:
+            selected.append(i)
+            remaining -= tokens[i]
+    return np.asarray(selected, dtype=np.intp)
+
+# Merge the results fetched for the queries of a search (in the order of the queries) and select the contexts
+def rank_contexts(queries, fetches):
+    query = ' '.join(queries)
+    candidates = associations_of_fetches(fetches).aggregate()
+
+    # documents with matching keywords the vector search didn't find
+    if HYBRID_FUSION != "none":
+        found = set(candidates.doc_ids)
+        bm25_only = list(dict.fromkeys(doc_id for _, _, bm25_top in fetches for doc_id, _ in bm25_top if doc_id not in found))
+        metadatas = doc_manager.get_metadata_by_ids(bm25_only)
+        bm25_only = [metadatas[doc_id] for doc_id in bm25_only if doc_id in metadatas]
+        candidates = candidates.concat(Candidates.of_metadatas(bm25_only, np.full(len(bm25_only), np.nan)))
+        print("bm25 only: ", [metadata['doc_id'] for metadata in bm25_only])
+    if not len(candidates):
+        return []
+
+    scores = fuse_scores(candidates.scores, get_avg_bm25_scores(query, candidates.doc_ids))
+    # with "none" the documents are taken in the order of the vector search, BM25 only adds to the score they are reported and filtered with
+    order = np.argsort(-(candidates.scores if HYBRID_FUSION == "none" else scores), kind='stable')
+    n_tokens = candidates.n_tokens
 
     full_doc_score = 1.
-    # full_doc_ids = [doc_id for doc_id, _, score in associations if score > full_doc_score]
+    docs = {} # doc_id -> document, None if it is not found
+    def load(rows):
+        doc_ids = [candidates.doc_ids[i] for i in rows if candidates.doc_ids[i] not in docs]
+        docs.update(zip(doc_ids, doc_manager.get_document_by_ids(doc_ids)))
 
-    doc_ids = [i[0] for i in agg_list]
-    docs = doc_manager.get_document_by_ids(doc_ids)
-    bm25_scores = get_avg_bm25_scores(' '.join(queries), doc_ids)
-    # min_bm25_scores = min(bm25_scores)
+    # documents without a stored count are read and counted together, the rest are never tokenized again
+    unknown = order[np.isnan(n_tokens[order])]
+    load(unknown)
+    counted = [i for i in unknown if docs[candidates.doc_ids[i]]]
+    n_tokens[counted] = count_tokens_batch([docs[candidates.doc_ids[i]] for i in counted])
+    missing = np.isnan(n_tokens)
+
+    # only the selected documents are read, a selected document that is missing is dropped and the selection made again
+    values = scores/(1+n_tokens/150)
+    while True:
+        rows = order[~missing[order] & ((scores[order] > full_doc_score) | (values[order] > RETRIEVAL_MIN_VALUE))]
+        selected = rows[budgeted_selection(n_tokens[rows], RETRIEVAL_TOKEN_LIMIT)]
+        load(selected)
+        not_found = [i for i in selected if docs[candidates.doc_ids[i]] is None]
+        if not not_found:
+            break
+        missing[not_found] = True
 
     ctx_list = []
-    token_limit = RETRIEVAL_TOKEN_LIMIT
-    for (doc_id, score),doc,bm25_score in zip(agg_list,docs,bm25_scores):
-        if not doc: # None means doc is not found
-            continue
-        # score += (bm25_score - min_bm25_scores)/10
-        score += bm25_score*BM25_WEIGHT
-        ctx = ConversationContext(doc_id, doc, score, time_dict[doc_id])
-        print(token_limit, ctx)
-        if token_limit > ctx.tokens and (score > full_doc_score or ctx.value > RETRIEVAL_MIN_VALUE):
-            ctx_list.append(ctx)
-            token_limit -= ctx.tokens
-    
+    for i in selected:
+        doc_id = candidates.doc_ids[i]
+        ctx = ConversationContext(doc_id, docs[doc_id], float(scores[i]), candidates.doc_times[i], tokens=int(n_tokens[i]))
+        print(ctx)
+        ctx_list.append(ctx)
+
     ctx_list = sorted(ctx_list, key=lambda x: x.doc_time)
     return ctx_list
@@ -0,0 +1,115 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from settings import INDEX_IDLE_SECONDS, INDEX_BUSY_SHARE, INDEX_BUDGET_INTERVAL, INDEX_MAX_STALENESS
+
+# Decides when background indexing may run. Chat requests have priority: while one is running,
+# or for INDEX_IDLE_SECONDS after the last one, ingestion steps may only use INDEX_BUSY_SHARE of
+# every INDEX_BUDGET_INTERVAL seconds (summed over all ingestion workers), and the rest wait at
+# the start of their next step. A step that runs over the budget takes the time from the next
+# windows, budget left unused in a window is not saved up for later ones. Once a file has waited INDEX_MAX_STALENESS seconds to be indexed
+# the budget no longer applies, so steady chat traffic can delay indexing but never stop it.
+class IndexingScheduler():
+    def __init__(self, idle_seconds=INDEX_IDLE_SECONDS, busy_share=INDEX_BUSY_SHARE,
+                 interval=INDEX_BUDGET_INTERVAL, max_staleness=INDEX_MAX_STALENESS):
+        self.idle_seconds = idle_seconds
+        self.busy_share = busy_share
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.condition = threading.Condition()
+        self.active = 0 # chat requests running
+        self.last_active = None
+        self.window_start = time.monotonic()
+        self.window_used = 0. # seconds of ingestion steps in the current window
+        self.waiting_since = {} # path -> time of the first event not indexed yet
+        self.sources = {} # name -> function returning the stats of a component, for metrics
+        self.counters = {"steps": 0, "throttled_steps": 0, "throttled_seconds": 0., "stale_steps": 0, "indexed": 0}
+        self.last_lag = None
+
+    @contextmanager
+    def interactive(self):
+        with self.condition:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.last_active = time.monotonic()
+                self.condition.notify_all()
+
+    # A file changed and waits to be indexed, the first event counts for its lag
+    def enqueued(self, path):
+        with self.condition:
+            self.waiting_since.setdefault(path, time.monotonic())
+
+    # The latest change of the file is indexed (or failed)
+    def indexed(self, path):
+        with self.condition:
+            since = self.waiting_since.pop(path, None)
+            if since is not None:
+                self.last_lag = time.monotonic() - since
+                self.counters["indexed"] += 1
+
+    def is_busy(self, now):
+        return self.active > 0 or (self.last_active is not None and now - self.last_active < self.idle_seconds)
+
+    def oldest_wait(self, now):
+        return now - min(self.waiting_since.values()) if self.waiting_since else 0.
+
+    # Wrap one preemptible unit of ingestion work, waits until it may run
+    @contextmanager
+    def step(self):
+        waited = 0.
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now - self.window_start >= self.interval:
+                    windows = int((now - self.window_start) // self.interval)
+                    self.window_start += windows * self.interval
+                    self.window_used = max(self.window_used - windows * self.busy_share * self.interval, 0.)
+                if not self.is_busy(now) or self.window_used < self.busy_share * self.interval:
+                    break
+                if self.oldest_wait(now) >= self.max_staleness:
+                    self.counters["stale_steps"] += 1
+                    break
+                timeout = self.window_start + self.interval - now
+                if self.waiting_since:
+                    timeout = min(timeout, self.max_staleness - self.oldest_wait(now))
+                self.condition.wait(max(timeout, 0.01))
+                waited += time.monotonic() - now
+            self.counters["steps"] += 1
+            if waited:
+                self.counters["throttled_steps"] += 1
+                self.counters["throttled_seconds"] += waited
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.window_used += time.monotonic() - start
+
+    def register(self, name, stats):
+        with self.condition:
+            self.sources[name] = stats
+
+    def metrics(self):
+        with self.condition:
+            now = time.monotonic()
+            metrics = {
+                "busy": self.is_busy(now),
+                "active_requests": self.active,
+                "queue_depth": len(self.waiting_since),
+                "indexing_lag_seconds": self.oldest_wait(now),
+                "last_indexing_lag_seconds": self.last_lag,
+                "budget_used_seconds": self.window_used,
+                "budget_seconds": self.busy_share * self.interval,
+                **self.counters,
+            }
+            sources = dict(self.sources)
+        for name, stats in sources.items():
+            metrics[name] = stats()
+        return metrics
+
+indexing_scheduler = IndexingScheduler()
@@ -0,0 +1,113 @@
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+def normalize_query(query_str):
+    return re.sub(r'\W+', ' ', query_str.lower()).strip()
+
+class CachedSearch():
+    def __init__(self, queries, vectors, time_ranges, version, contexts):
+        self.queries = queries # normalized
+        self.vectors = vectors # normalized embeddings of the queries, one row per query
+        self.time_ranges = time_ranges # resolved time range of the query of each row
+        self.version = version
+        self.contexts = contexts
+
+# Ranked contexts of earlier searches, for searches with the same queries after normalization or with
+# queries whose embeddings are all at least `similarity` close to those of an earlier search.
+# A result is only valid for the corpus version it was retrieved from, the caller passes the
+# current one, so every change of the documents makes all earlier results stale. Versions only
+# increase, a result retrieved at an older version than the newest one seen is not kept.
+# The queries are embedded as they are, with the function the search embeds them with, so the
+# cache of get_embedding_vectors serves the search what a miss here has embedded.
+# Close embeddings can still ask for different dates ("notes from 2023" and "notes from 2022"),
+# a query only matches one with the same time range as `time_range` resolves it.
+class SearchCache():
+    def __init__(self, embed=None, time_range=None, max_size=256, similarity=0.95):
+        self.embed = embed # list of texts -> list of vectors, None to only match normalized text
+        self.time_range = time_range # query -> the (start, end) it searches in, None without one
+        self.newest = None # newest version put
+        self.max_size = max_size
+        self.similarity = similarity
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> CachedSearch, most recently used last
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(queries):
+        return tuple(sorted(normalize_query(query_str) for query_str in queries))
+
+    def _vectors(self, queries):
+        vectors = np.asarray(self.embed(list(queries)), dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def _time_ranges(self, queries):
+        return [self.time_range(query_str) if self.time_range else None for query_str in queries]
+
+    def get(self, queries, version):
+        key = self.key(queries)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.version == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return list(entry.contexts)
+            candidates = [(key, entry) for key, entry in self.entries.items() if entry.version == version and len(entry.queries) == len(key)]
+        if not self.embed or not candidates:
+            with self.lock:
+                self.misses += 1
+            return None
+        vectors = self._vectors(queries)
+        time_ranges = self._time_ranges(queries)
+        best, best_similarity = None, self.similarity
+        for candidate_key, entry in candidates:
+            similarity = vectors @ entry.vectors.T
+            # queries of different time ranges never match
+            similarity[[[a != b for b in entry.time_ranges] for a in time_ranges]] = -np.inf
+            # every query has a close one in the earlier search and the other way round
+            worst = min(similarity.max(axis=1).min(), similarity.max(axis=0).min())
+            if worst >= best_similarity:
+                best, best_similarity = candidate_key, worst
+        with self.lock:
+            entry = self.entries.get(best) if best is not None else None
+            if entry is None or entry.version != version:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best)
+            self.semantic_hits += 1
+            return list(entry.contexts)
+
+    # If a search with this query would be answered from the cache, without looking at the other queries
+    def contains(self, query_str, version):
+        query_str = normalize_query(query_str)
+        with self.lock:
+            return any(entry.version == version and query_str in entry.queries for entry in self.entries.values())
+
+    def put(self, queries, version, contexts):
+        key = self.key(queries)
+        vectors, time_ranges = (self._vectors(queries), self._time_ranges(queries)) if self.embed else (None, None)
+        with self.lock:
+            if self.newest is not None and version < self.newest: # a slow search, the corpus changed meanwhile
+                return
+            self.newest = version
+            for stale_key in [stale_key for stale_key, entry in self.entries.items() if entry.version < version]:
+                del self.entries[stale_key]
+            self.entries[key] = CachedSearch(key, vectors, time_ranges, version, list(contexts))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.semantic_hits + self.misses
+            return {
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.semantic_hits) / total if total else 0.0,
+                "size": len(self.entries),
+            }
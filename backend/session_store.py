@@ -0,0 +1,67 @@
+import hashlib
+import threading
+import time
+
+from settings import SESSION_TTL, SESSION_MAX_NUM
+
+# A conversation is identified by its user and a fingerprint of its first user message,
+# the same rule the server used before with a single global, but now kept per session.
+def conversation_fingerprint(messages):
+    first_message = messages[1]['content'] if len(messages) > 1 else messages[0]['content']
+    return hashlib.sha1(first_message.encode('utf-8')).hexdigest()
+
+# A request continues a session if it has more than the first user message and its messages
+# extend the ones of the last request, or go back to one of them (undo in the frontend)
+def continues(history, messages):
+    if len(messages) <= 2 or history is None:
+        return False
+    return messages[:len(history)] == history or history[:len(messages) - 1] == messages[:-1]
+
+class ConversationSession():
+    def __init__(self, chat_time):
+        self.chat_time = chat_time # used as the conversation title when saving
+        self.prompt_messages = None # system prompt followed by the one-shot preset messages
+        self.history = None # (role, content) of the messages of the last request
+        self.last_access = time.monotonic()
+
+class SessionStore():
+    def __init__(self, ttl=SESSION_TTL, max_sessions=SESSION_MAX_NUM):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.sessions = {}
+
+    def get_or_create(self, user, messages, chat_time):
+        """
+        Return (session, continued) for the conversation the messages belong to.
+        """
+        key = (user, conversation_fingerprint(messages))
+        history = [(message['role'], message['content']) for message in messages]
+        now = time.monotonic()
+        with self.lock:
+            self._evict(now)
+            session = self.sessions.get(key)
+            # a new conversation can open with the same message as an earlier one ("hi")
+            continued = session is not None and continues(session.history, history)
+            if not continued:
+                session = ConversationSession(chat_time)
+                self.sessions[key] = session
+            session.history = history
+            session.last_access = now
+            return session, continued
+
+    def _evict(self, now):
+        expired = [key for key, session in self.sessions.items() if now - session.last_access > self.ttl]
+        for key in expired:
+            del self.sessions[key]
+        if len(self.sessions) >= self.max_sessions:
+            # drop the least recently used sessions to make room for a new one
+            by_access = sorted(self.sessions.items(), key=lambda x: x[1].last_access)
+            for key, _ in by_access[:len(self.sessions) - self.max_sessions + 1]:
+                del self.sessions[key]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
+
+session_store = SessionStore()
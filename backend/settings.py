@@ -4,6 +4,7 @@ NICK_NAME = 'Peter' # This is your nick name. Make sure to set it at the beginni
 EMBEDDING_BASE_URL = 'https://api.openai.com/v1'
 EMBEDDING_API_KEY = 'your-api-key'
 EMBEDDING_MODEL_NAME = "ada"
+EMBEDDING_ENCODING = "base64" # How vectors come back: "base64" (OpenAI format), "float" (JSON lists) or "binary" (raw float32, only external_example/embedding_server.py)
 
 CHAT_BASE_URL = 'https://api.openai.com/v1' # Modify to your OpenAI compatible API url
 CHAT_API_KEY = 'your-api-key'
@@ -35,6 +36,40 @@ RETRIEVAL_TOKEN_LIMIT = 2048  # Maximum token limit for the retrieved contexts
 RETRIEVAL_NUM_CHOICES = 10  # Number of top choices or results to retrieve for each query
 RETRIEVAL_MIN_VALUE = 0.25  # Minimum threshold for the value of retrieved documents
 BM25_WEIGHT = 0.1  # Weight given to the BM25 score when adjusting the final score of a document
+SEARCH_MAX_WORKERS = 4  # Maximum number of searches running at the same time across all conversations
+# How BM25 candidates from the whole corpus join the vector candidates. "none" keeps the previous ranking: the documents are taken
+# in the order of the vector search and BM25 only adds to their score. "zscore" (weighted sum of standardized scores) or "rrf"
+# (reciprocal rank fusion) also bring in documents only BM25 finds and rank by the fused score, which changes the results: recall@10
+# on the synthetic corpus of benchmarks/bench_hybrid.py (20k digests) is 0.56 with "none", 0.99 with "zscore" and 0.98 with "rrf",
+# for about 3ms of BM25 per query
+HYBRID_FUSION = "none"
+HYBRID_BM25_WEIGHT = 0.3  # Weight of BM25 against the vector search in the fusion
+HYBRID_BM25_CANDIDATES = 20  # Number of top BM25 documents added as candidates
+HYBRID_RRF_K = 60  # Rank offset of reciprocal rank fusion
+
+# ---Cache Settings--- #
+EMBEDDING_CACHE_SIZE = 10000  # Number of embeddings kept in memory
+EMBEDDING_CACHE_PATH = 'digests/embedding_cache.sqlite3'  # Persistent embedding cache, set to None to keep embeddings in memory only
+DOCUMENT_CACHE_SIZE = 64*1024*1024  # Bytes of digest documents kept in memory for retrieval
+DOCUMENT_CACHE_PRELOAD = False  # Read all digests into the document cache at startup (as far as they fit)
+SEARCH_CACHE_SIZE = 256  # Number of ranked search results kept until the digests change
+SEARCH_CACHE_SIMILARITY = 0.95  # Minimum cosine similarity of every query to reuse the result of a different search, set to 1 to only reuse searches with the same words
+
+# ---Ingestion Settings--- #
+FILE_DEBOUNCE_SECONDS = 2  # A changed file is handled once it hasn't changed again for this long
+DIGEST_MAX_CONCURRENCY = 8  # Maximum number of summaries requested from the LLM at the same time
+DIGEST_MAX_RETRIES = 2  # Times a failed summary request is repeated before the file fails
+INGEST_WORKERS = {"read": 2, "digest": 4, "chunk": 2, "embed": 2}  # Worker threads of each ingestion stage, digest makes the LLM calls
+INGEST_QUEUE_SIZE = 16  # Files waiting in front of each ingestion stage before the stage before it has to wait
+INGEST_COMMIT_BATCH = 32  # Maximum number of files committed to the indexes at once
+INDEX_IDLE_SECONDS = 30  # The server counts as busy for this long after a chat request
+INDEX_BUSY_SHARE = 0.2  # Share of the time ingestion may work while the server is busy
+INDEX_BUDGET_INTERVAL = 10  # Seconds over which that share is measured
+INDEX_MAX_STALENESS = 300  # Seconds after which a waiting file is indexed even when the server is busy
+
+# ---Session Settings--- #
+SESSION_TTL = 6*3600  # Seconds a conversation is kept in memory after its last message
+SESSION_MAX_NUM = 256  # Maximum number of conversations kept in memory at the same time
 
 # ---Prompts--- #
 SUMMARY_PROMPT='''You are the "ASSISTANT" and your task is to take a detailed note about {NICK_NAME} from a conversation with you. You should focus on observations on {NICK_NAME}'s situation and special things mentioned by him but you doesn't need to include assistant's (your own) words unless addressed by {NICK_NAME}.{LANGUAGE_PREFERENCE} Don't write a title and don't write anything else before or after the note.'''
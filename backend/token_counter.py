@@ -0,0 +1,58 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import tiktoken
+
+ENCODING_NAME = "o200k_base" # This is only approximation
+CACHE_SIZE = 100000
+
+_encoding = None
+_lock = threading.Lock()
+_counts = OrderedDict() # content hash -> number of tokens, most recently used last
+
+# One encoder for the whole process, loading it is much slower than encoding a digest
+def get_encoding():
+    global _encoding
+    if _encoding is None:
+        with _lock:
+            if _encoding is None:
+                _encoding = tiktoken.get_encoding(ENCODING_NAME)
+    return _encoding
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def _cached(key):
+    with _lock:
+        count = _counts.get(key)
+        if count is not None:
+            _counts.move_to_end(key)
+        return count
+
+def _remember(key, count):
+    with _lock:
+        _counts[key] = count
+        _counts.move_to_end(key)
+        while len(_counts) > CACHE_SIZE:
+            _counts.popitem(last=False)
+
+def count_tokens(text):
+    key = content_hash(text)
+    count = _cached(key)
+    if count is None:
+        count = len(get_encoding().encode(text))
+        _remember(key, count)
+    return count
+
+# Count many texts at once, the ones not counted before are encoded in one encode_batch call
+def count_tokens_batch(texts):
+    keys = [content_hash(text) for text in texts]
+    counts = [_cached(key) for key in keys]
+    missing = {key: text for key, text, count in zip(keys, texts, counts) if count is None}
+    if missing:
+        for key, tokens in zip(missing, get_encoding().encode_batch(list(missing.values()))):
+            _remember(key, len(tokens))
+            missing[key] = len(tokens)
+        counts = [missing[key] if count is None else count for key, count in zip(keys, counts)]
+    return counts
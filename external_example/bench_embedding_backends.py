@@ -0,0 +1,58 @@
+# CPU benchmark of the embedding backends and of length bucketing: sentences/sec of each backend
+# with and without bucketing, and the cosine similarity of its embeddings to those of the fp32
+# PyTorch model (drift). The texts mix short queries with 100-character chunks, as the batches of
+# the server do.
+#
+# Usage (from the external_example folder):
+#   python bench_embedding_backends.py --texts 2048 --backends torch onnx onnx-int8
+import argparse
+import random
+import time
+
+import numpy as np
+
+from embedding_models import load_model, encode_bucketed
+from bench_embedding_server import make_texts
+from embedding_server import EMBEDDING_MODEL_NAME, EMBEDDING_QUANTIZATION, EMBEDDING_ONNX_DIR, EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_BATCH_TOKENS
+
+
+def run(model, texts, batch_size, max_tokens, repeat):
+    encode_bucketed(model, texts[:batch_size], batch_size, max_tokens) # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        vectors = np.concatenate([encode_bucketed(model, texts[i:i+batch_size], batch_size, max_tokens)
+                                  for i in range(0, len(texts), batch_size)])
+    return len(texts) * repeat / (time.perf_counter() - start), vectors
+
+
+def normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--texts", type=int, default=2048)
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx", "onnx-int8"])
+    parser.add_argument("--batch-size", type=int, default=EMBEDDING_MAX_BATCH_SIZE)
+    parser.add_argument("--batch-tokens", type=int, default=EMBEDDING_BATCH_TOKENS or 8192)
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    texts = make_texts(args.texts, random.Random(0))
+    baseline = None
+    print(f"{args.texts} texts, batches of {args.batch_size}, model {EMBEDDING_MODEL_NAME}")
+    print(f"{'backend':>10} {'bucketing':>10} {'sent/s':>8} {'mean cos':>9} {'min cos':>8}")
+    for backend in ["torch"] + [backend for backend in args.backends if backend != "torch"]:
+        model = load_model(EMBEDDING_MODEL_NAME, backend, EMBEDDING_QUANTIZATION, EMBEDDING_ONNX_DIR)
+        for max_tokens in (0, args.batch_tokens):
+            speed, vectors = run(model, texts, args.batch_size, max_tokens, args.repeat)
+            vectors = normalize(vectors)
+            if baseline is None:
+                baseline = vectors # torch fp32 without bucketing
+            cosine = np.sum(vectors * baseline, axis=1)
+            if backend in args.backends:
+                print(f"{backend:>10} {'on' if max_tokens else 'off':>10} {speed:>8.1f} {cosine.mean():>9.5f} {cosine.min():>8.5f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Throughput/latency benchmark of the embedding server on CPU, batched against unbatched serving.
+# Many clients send single-string requests at the same time, a mix of short queries and
+# 100-character chunks like chat searches and ingestion do, to the app in this process.
+# Unbatched encodes every request on its own (max batch size 1), batched lets the requests
+# waiting together share one encode call.
+#
+# Usage (from the external_example folder):
+#   python bench_embedding_server.py --requests 512 --clients 32 --max-batch-size 64 --max-wait-ms 5
+import argparse
+import asyncio
+import random
+import time
+
+import httpx
+import numpy as np
+
+import embedding_server
+from embedding_server import EmbeddingBatcher
+
+
+def make_texts(n, rng):
+    words = ["memory", "elephie", "note", "meeting", "project", "garden", "travel", "budget", "music",
+             "friend", "dinner", "python", "report", "weekend", "doctor", "book", "plan", "idea"]
+    texts = []
+    for _ in range(n):
+        if rng.random() < 0.5: # query
+            texts.append(' '.join(rng.choices(words, k=rng.randint(2, 6))))
+        else: # chunk
+            text = ''
+            while len(text) < 100:
+                text += rng.choice(words) + ' '
+            texts.append(text[:100])
+    return texts
+
+
+async def run(texts, clients):
+    latencies = []
+    queue = asyncio.Queue()
+    for text in texts:
+        queue.put_nowait(text)
+
+    async def client_loop(client):
+        while not queue.empty():
+            text = queue.get_nowait()
+            start = time.perf_counter()
+            response = await client.post("/v1/embeddings", json={"model": embedding_server.EMBEDDING_MODEL_NAME, "input": text})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+
+    async with httpx.AsyncClient(app=embedding_server.app, base_url="http://bench", timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[client_loop(client) for _ in range(clients)])
+        total = time.perf_counter() - start
+    return total, np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=512)
+    parser.add_argument("--clients", type=int, default=32, help="requests in flight at the same time")
+    parser.add_argument("--max-batch-size", type=int, default=embedding_server.EMBEDDING_MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=embedding_server.EMBEDDING_MAX_WAIT_MS)
+    args = parser.parse_args()
+
+    texts = make_texts(args.requests, random.Random(0))
+    embedding_server.start_embedding()
+    embedding_server.encode(texts[:8]) # warm up
+    configs = [("unbatched", 1, 0.), ("batched", args.max_batch_size, args.max_wait_ms)]
+    print(f"{args.requests} requests, {args.clients} clients, model {embedding_server.EMBEDDING_MODEL_NAME}")
+    print(f"{'mode':>10} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'avg batch':>10}")
+    for name, max_batch_size, max_wait_ms in configs:
+        embedding_server.batcher = EmbeddingBatcher(embedding_server.encode, max_batch_size, max_wait_ms/1000)
+        total, latencies = asyncio.run(run(texts, args.clients))
+        stats = embedding_server.batcher.stats()
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        print(f"{name:>10} {len(texts)/total:>8.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f} {stats['texts']/max(stats['batches'], 1):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+# Scaling benchmark of the embedding worker pool on CPU: sentences/sec of the model in the server
+# process against pools of 1, 2, 4 and 8 worker processes, every pool dividing the cores between
+# its workers unless --threads is given. The batches are the size the server's batcher makes.
+#
+# Usage (from the external_example folder):
+#   python bench_embedding_workers.py --texts 2048 --workers 1 2 4 8
+import os
+import time
+import random
+import argparse
+
+from embedding_models import load_model, encode_bucketed, EmbeddingWorkerPool
+from bench_embedding_server import make_texts
+from embedding_server import EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND
+
+
+def run(encode, texts, batch_size, repeat):
+    encode(texts[:batch_size]) # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for i in range(0, len(texts), batch_size):
+            encode(texts[i:i+batch_size])
+    return len(texts) * repeat / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--texts", type=int, default=2048)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--threads", type=int, default=0, help="CPU threads of each worker, 0 divides the cores")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batch-tokens", type=int, default=8192)
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND)
+    parser.add_argument("--model", default=EMBEDDING_MODEL_NAME)
+    parser.add_argument("--repeat", type=int, default=2)
+    args = parser.parse_args()
+
+    texts = make_texts(args.texts, random.Random(0))
+    model_args = (args.model, args.backend)
+    print(f"{args.texts} texts, batches of {args.batch_size}, {os.cpu_count()} cores, model {args.model} ({args.backend})")
+    print(f"{'mode':>12} {'threads':>8} {'sent/s':>8} {'speedup':>8}")
+    model = load_model(*model_args)
+    baseline = run(lambda batch: encode_bucketed(model, batch, args.batch_size, args.batch_tokens), texts, args.batch_size, args.repeat)
+    print(f"{'in process':>12} {'all':>8} {baseline:>8.1f} {1:>8.2f}")
+    del model
+    for n_workers in args.workers:
+        threads = args.threads or max(1, (os.cpu_count() or 1) // n_workers)
+        pool = EmbeddingWorkerPool(n_workers, model_args, threads, args.batch_size, args.batch_tokens)
+        speed = run(pool.encode, texts, args.batch_size, args.repeat)
+        pool.close()
+        print(f"{str(n_workers) + ' workers':>12} {threads:>8} {speed:>8.1f} {speed / baseline:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
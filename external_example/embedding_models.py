@@ -0,0 +1,219 @@
+import os
+import re
+import queue
+import atexit
+import signal
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Model loading and encoding of embedding_server.py. Importing this module loads nothing, so the
+# worker processes of EmbeddingWorkerPool can import it.
+
+
+# The ONNX backends of SentenceTransformer are only in newer versions and need optimum, which
+# older installs of the example don't have (see requirements.txt)
+def check_onnx_support(backend):
+    import sentence_transformers
+    version = sentence_transformers.__version__
+    if tuple(int(part) for part in re.findall(r'\d+', version)[:2]) < (3, 2):
+        raise RuntimeError(f"EMBEDDING_BACKEND={backend} needs sentence-transformers>=3.2, installed is {version}: "
+                           "pip install -r requirements.txt")
+    try:
+        import optimum.onnxruntime
+    except ImportError as e:
+        raise RuntimeError(f"EMBEDDING_BACKEND={backend} needs optimum with ONNX Runtime: pip install \"optimum[onnxruntime]\"") from e
+
+
+# The ONNX models are exported once into onnx_dir and loaded from there afterwards.
+# threads limits the CPU threads of the model, 0 leaves the default of the backend (all cores).
+def load_model(model_name, backend="torch", quantization="avx2", onnx_dir="onnx_models", threads=0):
+    from sentence_transformers import SentenceTransformer
+    if backend == "torch":
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        return SentenceTransformer(model_name)
+    if backend not in ("onnx", "onnx-int8"):
+        raise ValueError(f"unknown embedding backend: {backend}")
+    check_onnx_support(backend)
+    model_kwargs = {}
+    if threads:
+        import onnxruntime
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = threads
+        model_kwargs["session_options"] = session_options
+    export_dir = os.path.join(onnx_dir, model_name.replace('/', '--'))
+    if not os.path.exists(os.path.join(export_dir, "onnx", "model.onnx")):
+        print(f">exporting {model_name} to ONNX")
+        SentenceTransformer(model_name, backend="onnx").save_pretrained(export_dir)
+    if backend == "onnx":
+        return SentenceTransformer(export_dir, backend="onnx", model_kwargs=model_kwargs)
+    file_name = f"onnx/model_qint8_{quantization}.onnx"
+    if not os.path.exists(os.path.join(export_dir, file_name)):
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        print(f">quantizing {model_name} for {quantization}")
+        export_dynamic_quantized_onnx_model(SentenceTransformer(export_dir, backend="onnx"), quantization, export_dir)
+    return SentenceTransformer(export_dir, backend="onnx", model_kwargs={"file_name": file_name, **model_kwargs})
+
+
+# Encode the texts longest first in forward passes of similar lengths, each with at most max_tokens
+# tokens after padding, so short queries aren't padded to the length of the chunks batched with them
+def encode_bucketed(model, texts, max_batch_size=64, max_tokens=8192):
+    if max_tokens <= 0 or len(texts) <= 1:
+        return model.encode(texts, batch_size=max_batch_size, convert_to_numpy=True)
+    lengths = [len(ids) for ids in model.tokenizer(texts, truncation=True, max_length=model.max_seq_length)["input_ids"]]
+    order = np.argsort(lengths, kind='stable')[::-1]
+    vectors = None
+    start = 0
+    while start < len(order):
+        batch_size = max(1, min(max_batch_size, max_tokens // max(lengths[order[start]], 1)))
+        batch = order[start:start+batch_size]
+        batch_vectors = model.encode([texts[i] for i in batch], batch_size=len(batch), convert_to_numpy=True)
+        if vectors is None:
+            vectors = np.empty((len(texts), batch_vectors.shape[1]), dtype=batch_vectors.dtype)
+        vectors[batch] = batch_vectors
+        start += len(batch)
+    return vectors
+
+
+def _worker_main(conn, model_args, threads, max_batch_size, max_tokens, capacity):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C reaches the whole process group, the server stops the workers
+    model = load_model(*model_args, threads=threads)
+    dim = model.encode(["dimension"], convert_to_numpy=True).shape[1]
+    conn.send(dim)
+    memory = shared_memory.SharedMemory(name=conn.recv())
+    output = np.ndarray((capacity, dim), dtype=np.float32, buffer=memory.buf)
+    while True:
+        texts = conn.recv()
+        if texts is None:
+            break
+        try:
+            output[:len(texts)] = encode_bucketed(model, texts, max_batch_size, max_tokens)
+            conn.send(len(texts))
+        except Exception as e:
+            conn.send(RuntimeError(repr(e)))
+    del output
+    memory.close()
+
+
+# Replicas of the model in n_workers processes, with `threads` CPU threads each (0 divides the cores
+# between them). encode() shards a batch across the workers, every worker writes its embeddings
+# into its own block of shared memory and they are copied from there into the result, so vectors
+# are never pickled. A shard has at most `capacity` texts, larger batches take several rounds.
+# A worker that dies (e.g. killed for memory) fails the shard it was encoding and is started again
+# in the background, its block of shared memory is kept for the new one.
+class EmbeddingWorkerPool():
+    def __init__(self, n_workers, model_args, threads=0, max_batch_size=64, max_tokens=8192, capacity=256):
+        threads = threads or max(1, (os.cpu_count() or 1) // n_workers)
+        self.capacity = capacity
+        self.worker_args = (model_args, threads, max_batch_size, max_tokens, capacity)
+        self.context = multiprocessing.get_context("spawn") # forking a process with a loaded model isn't safe
+        self.processes, self.connections = [None] * n_workers, [None] * n_workers
+        self.memories, self.outputs = [], []
+        self.restarts = 0
+        self.closed = False
+        for i in range(n_workers):
+            self._spawn(i)
+        for i in range(n_workers): # the workers load their models at the same time
+            self._attach(i)
+        self.free = queue.Queue()
+        for i in range(n_workers):
+            self.free.put(i)
+        self.executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="embedding-worker")
+        atexit.register(self.close)
+
+    def _spawn(self, i):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_worker_main, args=(child_conn, *self.worker_args), daemon=True)
+        process.start()
+        child_conn.close() # only the worker holds its end, so the pipe breaks when it dies
+        self.processes[i], self.connections[i] = process, conn
+
+    # Wait for the next message of worker i, EOFError if it died
+    def _receive(self, i):
+        conn, process = self.connections[i], self.processes[i]
+        while not conn.poll(1):
+            if not process.is_alive():
+                raise EOFError(f"embedding worker {i} exited with code {process.exitcode}")
+        return conn.recv()
+
+    # Give worker i, once its model is loaded, its block of shared memory, made for the first worker of slot i
+    def _attach(self, i):
+        dim = self._receive(i)
+        if i == len(self.memories):
+            self.dim = dim
+            memory = shared_memory.SharedMemory(create=True, size=self.capacity * dim * 4)
+            self.memories.append(memory)
+            self.outputs.append(np.ndarray((self.capacity, dim), dtype=np.float32, buffer=memory.buf))
+        self.connections[i].send(self.memories[i].name)
+
+    # Start worker i again, the slot is only given back to encode() afterwards
+    def _restart(self, i):
+        try:
+            if not self.closed:
+                self.processes[i].join(timeout=1)
+                self._spawn(i)
+                self._attach(i)
+                self.restarts += 1
+                print(f">embedding worker {i} restarted")
+        except Exception as e: # tried again by the next shard the slot gets
+            print(f">embedding worker {i} failed to restart: {e!r}")
+        finally:
+            self.free.put(i)
+
+    def _run(self, texts, vectors, rows):
+        i = self.free.get()
+        try:
+            if not self.processes[i].is_alive():
+                raise EOFError(f"embedding worker {i} exited with code {self.processes[i].exitcode}")
+            self.connections[i].send(texts)
+            result = self._receive(i)
+        except (EOFError, OSError) as e:
+            threading.Thread(target=self._restart, args=(i,), daemon=True).start()
+            raise RuntimeError(f"embedding worker {i} stopped, restarting it") from e
+        except BaseException:
+            self.free.put(i)
+            raise
+        try:
+            if isinstance(result, Exception):
+                raise result
+            vectors[rows] = self.outputs[i][:result]
+        finally:
+            self.free.put(i)
+
+    def encode(self, texts):
+        vectors = np.empty((len(texts), self.dim), dtype=np.float32)
+        if not texts:
+            return vectors
+        # every shard gets texts of all lengths, so the workers finish at about the same time
+        n_shards = max(min(len(self.processes), len(texts)), -(-len(texts) // self.capacity))
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        shards = [order[k::n_shards] for k in range(n_shards)]
+        futures = [self.executor.submit(self._run, [texts[i] for i in shard], vectors, shard) for shard in shards]
+        for future in futures:
+            future.result()
+        return vectors
+
+    def stats(self):
+        return {"workers": len(self.processes), "alive": sum(process.is_alive() for process in self.processes), "restarts": self.restarts}
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except OSError: # the worker is gone already
+                pass
+        for process in self.processes:
+            process.join(timeout=10)
+        self.outputs = []
+        for memory in self.memories:
+            memory.close()
+            memory.unlink()
+        self.executor.shutdown()
@@ -1,10 +1,18 @@
 import os
-from typing import List, Optional, Union
-
-from fastapi import FastAPI
+import time
+import base64
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import List, Literal, Optional, Union
+
+import numpy as np
+from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
+
+from embedding_models import load_model, encode_bucketed, EmbeddingWorkerPool
 
 app = FastAPI(
     title="Embeddings API",
@@ -19,12 +27,106 @@ app.add_middleware(
 )
 
 EMBEDDING_MODEL_NAME = 'BAAI/bge-base-en-v1.5' # Choose a custom embedding model
-embeddings = SentenceTransformer(EMBEDDING_MODEL_NAME)
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", 64)) # Most texts of concurrent requests encoded together
+EMBEDDING_MAX_WAIT_MS = float(os.getenv("EMBEDDING_MAX_WAIT_MS", 5)) # How long a request waits for others to join its batch, 0 encodes every request alone
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch") # "torch", "onnx" (ONNX Runtime) or "onnx-int8" (ONNX Runtime, int8 dynamic quantization)
+EMBEDDING_QUANTIZATION = os.getenv("EMBEDDING_QUANTIZATION", "avx2") # Instruction set the int8 model is made for: "arm64", "avx2", "avx512" or "avx512_vnni"
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", "onnx_models") # Where the exported ONNX models are kept
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", 8192)) # Padded tokens per forward pass when texts are bucketed by length, 0 to encode a batch as one
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", 0)) # Model replicas in worker processes sharing every batch, 0 runs the model in the server process
+EMBEDDING_WORKER_THREADS = int(os.getenv("EMBEDDING_WORKER_THREADS", 0)) # CPU threads of each worker, 0 divides the cores between the workers
+MODEL_ARGS = (EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND, EMBEDDING_QUANTIZATION, EMBEDDING_ONNX_DIR)
+
+
+# Collects the texts of concurrent requests (chat queries, ingestion chunks...) into one encode call.
+# The first request waits at most max_wait seconds for others, until max_batch_size texts are
+# collected, then the batch is encoded on the batcher's thread and every request gets its rows.
+class EmbeddingBatcher():
+    def __init__(self, encode, max_batch_size=EMBEDDING_MAX_BATCH_SIZE, max_wait=EMBEDDING_MAX_WAIT_MS/1000):
+        self.encode = encode # list of texts -> array of embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue() # (texts, future)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "texts": 0, "batches": 0}
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, texts) -> Future:
+        future = Future()
+        self.queue.put((texts, future))
+        return future
+
+    def collect(self):
+        pending = [self.queue.get()]
+        n_texts = len(pending[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while n_texts < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            pending.append(item)
+            n_texts += len(item[0])
+        return pending
+
+    def run(self):
+        while True:
+            pending = self.collect()
+            texts = [text for request_texts, _ in pending for text in request_texts]
+            if len(pending) > 1:
+                print(f">batch of {len(pending)} requests, {len(texts)} texts")
+            try:
+                vectors = self.encode(texts)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for request_texts, future in pending:
+                future.set_result(vectors[start:start+len(request_texts)])
+                start += len(request_texts)
+            with self.lock:
+                self.counters["requests"] += len(pending)
+                self.counters["texts"] += len(texts)
+                self.counters["batches"] += 1
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, "waiting": self.queue.qsize()}
+
+
+embeddings = None # the model, None when it runs in worker processes
+worker_pool = None
+encode = None # list of texts -> array of embeddings
+batcher = None
+
+
+# Not done at import, since the worker processes import this module again
+@app.on_event("startup")
+def start_embedding():
+    global embeddings, worker_pool, encode, batcher
+    if batcher is not None:
+        return
+    if EMBEDDING_WORKERS > 0:
+        worker_pool = EmbeddingWorkerPool(EMBEDDING_WORKERS, MODEL_ARGS, EMBEDDING_WORKER_THREADS, EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_BATCH_TOKENS)
+        encode = worker_pool.encode
+    else:
+        embeddings = load_model(*MODEL_ARGS)
+        encode = lambda texts: encode_bucketed(embeddings, texts, EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_BATCH_TOKENS)
+    batcher = EmbeddingBatcher(encode)
+
+
+@app.on_event("shutdown")
+def stop_embedding():
+    if worker_pool is not None:
+        worker_pool.close()
 
 
 class Embedding(BaseModel):
     object: str
-    embedding: List[float]
+    embedding: Union[List[float], str] # str for encoding_format="base64"
     index: int
 
 
@@ -37,6 +139,7 @@ class CreateEmbeddingRequest(BaseModel):
     model: Optional[str]
     input: Union[str, List[str]]
     user: Optional[str] = None
+    encoding_format: Literal["float", "base64"] = "float"
 
     class Config:
         schema_extra = {
@@ -57,29 +160,58 @@ class CreateEmbeddingResponse(BaseModel):
     "/v1/embeddings",
     response_model=CreateEmbeddingResponse,
 )
-def create_embedding(request: CreateEmbeddingRequest):
-    result = _create_embedding(**request.dict(exclude={"user", "model", "model_config"}))
-    return result
+async def create_embedding(request: CreateEmbeddingRequest, http_request: Request):
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    vectors = await asyncio.wrap_future(batcher.submit(texts))
+    if "application/octet-stream" in http_request.headers.get("accept", ""):
+        return _binary_embedding(texts, vectors)
+    return _create_embedding(request.input, vectors, request.encoding_format)
+
+
+def _count_tokens(input: List[str]):
+    total_tokens = 0
+    for text in input:
+        total_tokens += len(text) # MARK; could change to tokens, just for test now
+    return total_tokens
 
 
-def _create_embedding(input: Union[str, List[str]]):
-    print(">embedding called")
-    global embeddings
+# encoding_format="base64" is the format of OpenAI: the little-endian float32 bytes of each vector in base64,
+# which the openai client asks for by default
+def _create_embedding(input: Union[str, List[str]], vectors, encoding_format="float"):
     model_name = EMBEDDING_MODEL_NAME
     model_name_short = model_name.split("/")[-1]
     if isinstance(input, str):
-        return CreateEmbeddingResponse(data=[Embedding(embedding=embeddings.encode(input).tolist(), object="embedding", index=0)],
-                                       model=model_name_short, object='list',
-                                       usage=Usage(prompt_tokens=len(input), total_tokens=len(input))) # MARK; could change to tokens, just for test now
+        input = [input]
+    if encoding_format == "base64":
+        vectors = np.ascontiguousarray(vectors, dtype='<f4')
+        embeddings_data = [base64.b64encode(vector.tobytes()).decode('ascii') for vector in vectors]
     else:
-        print(">batch call")
-        data = [Embedding(embedding=embedding, object="embedding", index=i)
-                for i, embedding in enumerate(embeddings.encode(input).tolist())]
-        total_tokens = 0
-        for text in input:
-            total_tokens += len(text) # MARK; could change to tokens, just for test now
-        return CreateEmbeddingResponse(data=data, model=model_name_short, object='list',
-                                       usage=Usage(prompt_tokens=total_tokens, total_tokens=total_tokens))
+        embeddings_data = vectors.tolist()
+    data = [Embedding(embedding=embedding, object="embedding", index=i)
+            for i, embedding in enumerate(embeddings_data)]
+    total_tokens = _count_tokens(input)
+    return CreateEmbeddingResponse(data=data, model=model_name_short, object='list',
+                                   usage=Usage(prompt_tokens=total_tokens, total_tokens=total_tokens))
+
+
+# With "Accept: application/octet-stream" the body is the vectors as one little-endian float32 array of
+# shape (number of inputs, dimension), given in the X-Embedding-Shape header with the rest in headers too
+def _binary_embedding(input: List[str], vectors):
+    vectors = np.ascontiguousarray(vectors, dtype='<f4')
+    total_tokens = _count_tokens(input)
+    return Response(content=vectors.tobytes(), media_type="application/octet-stream", headers={
+        "X-Embedding-Shape": f"{vectors.shape[0]},{vectors.shape[1]}",
+        "X-Embedding-Model": EMBEDDING_MODEL_NAME.split("/")[-1],
+        "X-Usage-Total-Tokens": str(total_tokens),
+    })
+
+
+@app.get("/v1/embeddings/stats")
+def embedding_stats():
+    stats = batcher.stats()
+    if worker_pool is not None:
+        stats["workers"] = worker_pool.stats()
+    return stats
 
 
 if __name__ == "__main__":